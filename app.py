@@ -1,12 +1,22 @@
-from flask import Flask, render_template, request, jsonify, send_file, session
-from werkzeug.utils import secure_filename
-from PIL import Image, ImageDraw, ImageFont
-import pandas as pd
+from flask import Flask, Response, g, render_template, request, jsonify, send_file, session
+from PIL import Image
 import os
+import hashlib
+import math
+import time
 import uuid
+from functools import lru_cache
 from io import BytesIO
-import base64
 import zipfile
+import datasource
+import pdf_output
+import preview
+import renderer
+from fileutil import atomic_write
+from jobs import JobManager
+from metrics import metrics
+from render_cache import RenderCache
+from retention import Area, Sweeper, touch
 
 app = Flask(__name__)
 app.secret_key = 'a_very_long_and_random_secret_key_that_you_should_change'
@@ -14,18 +24,207 @@ app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['OUTPUT_FOLDER'] = 'outputs'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['FONT_FOLDER'] = 'static/fonts'
+# Default and largest width (in pixels) of /preview_certificate images
+app.config['PREVIEW_WIDTH'] = 1000
+app.config['PREVIEW_MAX_WIDTH'] = 2000
+# Print view: certificates per page and the width of the images it shows
+# (1600px fills an A4 landscape page at about 140 dpi)
+app.config['PRINT_PAGE_SIZE'] = 50
+app.config['PRINT_WIDTH'] = 1600
+# Every width gets its own set of JPEGs on disk, so ?width= is rounded up to
+# one of these (or down to the largest)
+app.config['PRINT_WIDTHS'] = (800, 1600, 2400)
+# How long browsers may cache batch outputs and template previews; their
+# names hold a uuid or content hash, so their content never changes
+app.config['OUTPUT_CACHE_SECONDS'] = 365 * 24 * 3600
+# Parsed spreadsheets, pickled by content hash
+app.config['SHEET_CACHE_FOLDER'] = 'cache/sheets'
+# Display-size copies of uploaded templates for the editor canvas, and the
+# box they are scaled into (twice the 800x600 canvas, for high-DPI screens)
+app.config['TEMPLATE_DISPLAY_FOLDER'] = 'cache/templates'
+app.config['TEMPLATE_DISPLAY_SIZE'] = (1600, 1200)
+# Number of processes used to render a batch (defaults to one per core)
+app.config['RENDER_WORKERS'] = int(os.environ.get('RENDER_WORKERS', 0)) or os.cpu_count() or 1
+# Memory budget for decoded templates kept between requests
+app.config['TEMPLATE_CACHE_BYTES'] = 256 * 1024 * 1024
+renderer.template_cache.max_bytes = app.config['TEMPLATE_CACHE_BYTES']
+# Also write every certificate to outputs/<id>/ next to the zip
+app.config['KEEP_LOOSE_FILES'] = False
+# Certificate encoding when a request doesn't pick one (see renderer.OUTPUT_PRESETS)
+app.config['OUTPUT_PRESET'] = 'png'
+# Rendered certificates by content hash, so unchanged rows are never rendered
+# twice. A cached batch is written to disk twice, once into its zip and once
+# into the cache, and the cache has to hold the whole batch for a re-run to
+# be quick. Requests may pass 'cache': false to skip it, e.g. for one-off
+# batches too big to keep (about 2.6 MB per A4 PNG)
+app.config['RENDER_CACHE_FOLDER'] = 'cache/renders'
+app.config['RENDER_CACHE_BATCHES'] = True
+# Background generation jobs: on-disk status records and how many run at once
+app.config['JOB_FOLDER'] = 'jobs'
+app.config['MAX_CONCURRENT_JOBS'] = 2
+# Retention: seconds between sweeps (0 turns sweeping off), then the age
+# and size limits of each folder it cleans
+app.config['RETENTION_INTERVAL'] = 600
+app.config['UPLOAD_MAX_AGE'] = 3 * 24 * 3600
+app.config['UPLOAD_QUOTA_BYTES'] = 2 * 1024 ** 3
+app.config['OUTPUT_MAX_AGE'] = 24 * 3600
+app.config['OUTPUT_QUOTA_BYTES'] = 5 * 1024 ** 3
+app.config['CACHE_MAX_AGE'] = 7 * 24 * 3600
+# As big as the outputs, so any batch whose zip is still kept can also be
+# re-run from the cache; past that, the least recently used renders go
+app.config['RENDER_CACHE_QUOTA_BYTES'] = app.config['OUTPUT_QUOTA_BYTES']
+app.config['JOB_MAX_AGE'] = 7 * 24 * 3600
 
 # Create necessary folders
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
 os.makedirs(app.config['FONT_FOLDER'], exist_ok=True)
+os.makedirs(app.config['TEMPLATE_DISPLAY_FOLDER'], exist_ok=True)
+
+preview_engine = preview.PreviewEngine()
+sheet_cache = datasource.SheetCache(app.config['SHEET_CACHE_FOLDER'])
+render_cache = RenderCache(app.config['RENDER_CACHE_FOLDER'])
+job_manager = JobManager(app.config['JOB_FOLDER'], max_jobs=app.config['MAX_CONCURRENT_JOBS'])
+
+def active_job_files():
+    """Files that queued and running jobs, in any worker, still need.
+
+    active() marks jobs whose worker is gone as failed, so an orphaned
+    record never keeps itself or its uploads from being swept.
+    """
+    for record in job_manager.active():
+        yield record['params'].get('template_path')
+        yield record['params'].get('excel_path')
+        yield job_manager.store.path(record['id'])
+
+sweeper = Sweeper([
+    Area('uploads', app.config['UPLOAD_FOLDER'],
+         app.config['UPLOAD_MAX_AGE'], app.config['UPLOAD_QUOTA_BYTES']),
+    Area('outputs', app.config['OUTPUT_FOLDER'],
+         app.config['OUTPUT_MAX_AGE'], app.config['OUTPUT_QUOTA_BYTES']),
+    Area('renders', app.config['RENDER_CACHE_FOLDER'],
+         app.config['CACHE_MAX_AGE'], app.config['RENDER_CACHE_QUOTA_BYTES'], nested=True),
+    Area('sheets', app.config['SHEET_CACHE_FOLDER'], app.config['CACHE_MAX_AGE']),
+    Area('templates', app.config['TEMPLATE_DISPLAY_FOLDER'], app.config['CACHE_MAX_AGE']),
+    Area('jobs', app.config['JOB_FOLDER'], app.config['JOB_MAX_AGE']),
+], interval=app.config['RETENTION_INTERVAL'], active_paths=active_job_files)
 
 ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'bmp'}
 ALLOWED_EXCEL_EXTENSIONS = {'xlsx', 'xls'}
 
+# Preview encodings: (PIL format, mimetype, save options)
+PREVIEW_FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg', {'quality': 85}),
+    'webp': ('WEBP', 'image/webp', {'quality': 80}),
+    'png': ('PNG', 'image/png', {}),
+}
+
 def allowed_file(filename, extensions):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in extensions
 
+def save_upload(file):
+    """Store an upload as uploads/<sha256>.<ext> and return (path, content_hash).
+
+    Identical content maps to the same file, so re-uploading a template or
+    sheet reuses the existing copy (and everything cached for it) instead of
+    adding another one.
+    """
+    extension = file.filename.rsplit('.', 1)[1].lower()
+    partial_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{uuid.uuid4().hex}.part")
+    digest = hashlib.sha256()
+    try:
+        with open(partial_path, 'wb') as f:
+            for block in iter(lambda: file.stream.read(1024 * 1024), b''):
+                digest.update(block)
+                f.write(block)
+        content_hash = digest.hexdigest()
+        filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{content_hash}.{extension}")
+        if os.path.exists(filepath):
+            # Seen before; keep it from expiring while it is in use again
+            touch(filepath)
+        else:
+            os.replace(partial_path, filepath)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    return filepath, content_hash
+
+def template_rendition(content_hash):
+    """Path of the display-size copy of an uploaded template, made on first request.
+
+    Templates with transparency are kept as PNG, the rest become JPEG.
+    Returns None if no upload has that content.
+    """
+    folder = app.config['TEMPLATE_DISPLAY_FOLDER']
+    for extension in ('jpg', 'png'):
+        path = os.path.join(folder, f"{content_hash}.{extension}")
+        if os.path.exists(path):
+            return path
+    
+    for extension in sorted(ALLOWED_IMAGE_EXTENSIONS):
+        source = os.path.join(app.config['UPLOAD_FOLDER'], f"{content_hash}.{extension}")
+        if os.path.exists(source):
+            break
+    else:
+        return None
+    
+    with Image.open(source) as img:
+        full_width, height = img.size
+    max_width, max_height = app.config['TEMPLATE_DISPLAY_SIZE']
+    width = max(1, min(max_width, int(full_width * max_height / height)))
+    # Shared with the renderer's cache; JPEGs are decoded straight at a reduced scale
+    img = renderer.template_cache.get(source, width if width < full_width else None)
+    if img.mode in ('RGBA', 'LA') or 'transparency' in img.info:
+        extension, save_options = 'png', {'format': 'PNG'}
+    else:
+        extension, save_options = 'jpg', {'format': 'JPEG', 'quality': 90}
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+    path = os.path.join(folder, f"{content_hash}.{extension}")
+    atomic_write(path, lambda f: img.save(f, **save_options))
+    return path
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.before_request
+def start_sweeper():
+    # Started lazily so each gunicorn worker runs its own after forking
+    sweeper.start()
+
+@app.after_request
+def record_request(response):
+    if 'request_start' in g:
+        metrics.observe('certgen_request_seconds', time.perf_counter() - g.request_start,
+                        endpoint=request.endpoint or 'unknown', method=request.method,
+                        status=response.status_code)
+    return response
+
+def cache_stats():
+    """Hit/miss counters of the in-process caches, read at scrape time.
+
+    Render pool workers have caches of their own; their lookups are counted
+    with inc() as each chunk comes back, and added to these.
+    """
+    caches = {
+        'template': renderer.template_cache,
+        'font': renderer.registry,
+        'sheet': sheet_cache,
+        'text': renderer.text_cache,
+        'render': render_cache,
+    }
+    for name, cache in caches.items():
+        yield 'certgen_cache_hits_total', {'cache': name}, cache.hits
+        yield 'certgen_cache_misses_total', {'cache': name}, cache.misses
+
+metrics.add_collector(cache_stats)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -42,31 +241,33 @@ def upload_template():
     if not allowed_file(file.filename, ALLOWED_IMAGE_EXTENSIONS):
         return jsonify({'error': 'Invalid file type'}), 400
     
-    # Generate unique filename
-    filename = secure_filename(f"{uuid.uuid4()}_{file.filename}")
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(filepath)
+    filepath, content_hash = save_upload(file)
     
-    # Get image dimensions
-    img = Image.open(filepath)
-    width, height = img.size
+    # Only the header is read; the browser fetches a display-size copy
+    # from the preview URL instead of the whole image inlined as base64
+    with Image.open(filepath) as img:
+        width, height = img.size
     
     # Store in session
     session['template_path'] = filepath
     session['template_dimensions'] = {'width': width, 'height': height}
     
-    # Convert image to base64 for preview
-    buffered = BytesIO()
-    img.save(buffered, format=img.format or 'PNG')
-    img_str = base64.b64encode(buffered.getvalue()).decode()
-    
     return jsonify({
         'success': True,
         'filename': file.filename,
         'dimensions': {'width': width, 'height': height},
-        'preview': f"data:image/png;base64,{img_str}"
+        'preview': f"/template_display/{content_hash}"
     })
 
+@app.route('/template_display/<content_hash>')
+def template_display(content_hash):
+    if len(content_hash) != 64 or not all(c in '0123456789abcdef' for c in content_hash):
+        return jsonify({'error': 'Template not found'}), 404
+    path = template_rendition(content_hash)
+    if path is None:
+        return jsonify({'error': 'Template not found'}), 404
+    return send_output(path)
+
 @app.route('/upload_excel', methods=['POST'])
 def upload_excel():
     if 'excel' not in request.files:
@@ -79,17 +280,17 @@ def upload_excel():
     if not allowed_file(file.filename, ALLOWED_EXCEL_EXTENSIONS):
         return jsonify({'error': 'Invalid file type'}), 400
     
-    filename = secure_filename(f"{uuid.uuid4()}_{file.filename}")
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(filepath)
+    filepath, excel_hash = save_upload(file)
     
     try:
-        df = pd.read_excel(filepath)
+        # Parse once; later endpoints load the cached frame by content hash
+        df = sheet_cache.load(filepath, excel_hash)
         columns = df.columns.tolist()
         row_count = len(df)
         
         # Store in session
         session['excel_path'] = filepath
+        session['excel_hash'] = excel_hash
         session['excel_columns'] = columns
         
         # Get first row as sample data
@@ -122,145 +323,527 @@ def preview_certificate():
             return jsonify({'error': 'Missing template or data'}), 400
         
         # Load data
-        df = pd.read_excel(excel_path)
+        df = sheet_cache.load(excel_path, session.get('excel_hash'))
         if len(df) == 0:
             return jsonify({'error': 'Excel file is empty'}), 400
         
-        # Create certificate
-        cert = create_certificate(template_path, df.iloc[0], fields)
+        options = request.get_json(silent=True) or {}
+        try:
+            width = preview_width(options)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        image_format = str(options.get('format', request.args.get('format', 'jpeg'))).lower()
+        if image_format not in PREVIEW_FORMATS:
+            return jsonify({'error': f'Unsupported preview format: {image_format}'}), 400
         
-        # Convert to base64
-        buffered = BytesIO()
-        cert.save(buffered, format='PNG')
-        img_str = base64.b64encode(buffered.getvalue()).decode()
+        # Render straight at display size instead of downscaling a full render
+        cert = create_certificate(template_path, df.iloc[0], fields, width=width)
         
-        return jsonify({
-            'success': True,
-            'preview': f"data:image/png;base64,{img_str}"
-        })
+        return send_file(encode_preview(cert, image_format), mimetype=PREVIEW_FORMATS[image_format][1])
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/preview_update', methods=['POST'])
+def preview_update():
+    """Update this session's preview, sending only the area that changed.
+    
+    The X-Preview-Full header says whether the body is the whole preview or
+    a tile to paste at the (left, top, right, bottom) in X-Preview-Box.
+    204 means nothing visible changed.
+    """
+    try:
+        template_path = session.get('template_path')
+        excel_path = session.get('excel_path')
+        fields = session.get('fields', {})
+        
+        if not template_path or not excel_path:
+            return jsonify({'error': 'Missing template or data'}), 400
+        
+        df = sheet_cache.load(excel_path, session.get('excel_hash'))
+        if len(df) == 0:
+            return jsonify({'error': 'Excel file is empty'}), 400
+        
+        options = request.get_json(silent=True) or {}
+        try:
+            width = preview_width(options)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        image_format = str(options.get('format', 'jpeg')).lower()
+        tile_format = str(options.get('tile_format', 'png')).lower()
+        if image_format not in PREVIEW_FORMATS or tile_format not in PREVIEW_FORMATS:
+            return jsonify({'error': 'Unsupported preview format'}), 400
+        
+        if 'preview_id' not in session:
+            session['preview_id'] = uuid.uuid4().hex
+        
+        base = renderer.template_cache.get(template_path, width)
+        with Image.open(template_path) as full_size:
+            scale = base.width / full_size.width
+        get_font = renderer.font_loader(renderer.default_font_paths(app.config['FONT_FOLDER']))
+        img, box = preview_engine.render(session['preview_id'], base, df.iloc[0], fields,
+                                         get_font, scale, full=bool(options.get('full')))
+        
+        if box is None:
+            response = send_file(encode_preview(img, image_format),
+                                 mimetype=PREVIEW_FORMATS[image_format][1])
+            response.headers['X-Preview-Full'] = '1'
+            box = (0, 0, img.width, img.height)
+        elif box[0] == box[2]:
+            response = app.response_class(status=204)
+        else:
+            response = send_file(encode_preview(img.crop(box), tile_format),
+                                 mimetype=PREVIEW_FORMATS[tile_format][1])
+            response.headers['X-Preview-Full'] = '0'
+        response.headers['X-Preview-Box'] = ','.join(str(v) for v in box)
+        response.headers['X-Preview-Size'] = f'{img.width},{img.height}'
+        return response
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def requested_output(options):
+    """Encoder settings asked for with 'output' (a preset name or a dict of settings)"""
+    return renderer.output_settings(options.get('output') or app.config['OUTPUT_PRESET'])
+
+def requested_caching(options):
+    """Whether a batch goes through the render cache; 'cache' overrides RENDER_CACHE_BATCHES"""
+    cache = options.get('cache', app.config['RENDER_CACHE_BATCHES'])
+    if isinstance(cache, str):
+        # From a query string, e.g. ?cache=0
+        return cache.lower() not in ('0', 'false', 'no', 'off')
+    return bool(cache)
+
+def preview_width(options):
+    """Requested preview width, clamped to the configured limits; ValueError if it isn't a number"""
+    width = options.get('width', request.args.get('width', app.config['PREVIEW_WIDTH']))
+    try:
+        width = int(width)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid preview width: {width!r}")
+    return max(1, min(width, app.config['PREVIEW_MAX_WIDTH']))
+
+def encode_preview(img, image_format):
+    """Encode a preview image in one of PREVIEW_FORMATS"""
+    buffered = BytesIO()
+    save_format, _, save_options = PREVIEW_FORMATS[image_format]
+    if save_format != 'PNG' and img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    img.save(buffered, format=save_format, **save_options)
+    buffered.seek(0)
+    return buffered
+
 @app.route('/generate_certificates', methods=['POST'])
 def generate_certificates():
     try:
         template_path = session.get('template_path')
         excel_path = session.get('excel_path')
         fields = session.get('fields', {})
+        options = request.get_json(silent=True) or {}
+        keep_files = options.get('keep_files', app.config['KEEP_LOOSE_FILES'])
+        cache = requested_caching(options)
         
         if not template_path or not excel_path:
             return jsonify({'error': 'Missing template or data'}), 400
+        try:
+            output = requested_output(options)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        result = generate_batch(template_path, excel_path, fields, keep_files,
+                                excel_hash=session.get('excel_hash'), output=output, cache=cache)
+        remember_batch(result, session)
+        
+        return jsonify({
+            'success': True,
+            'count': len(result['generated_files']),
+            'download_url': f"/download/{result['zip_filename']}"
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/generate_pdf', methods=['POST'])
+def generate_pdf():
+    """Render the batch as PDF: one multi-page file, or a zip with one PDF per student.
+
+    With an output_id, the PDF is made from the inputs that batch was
+    generated from rather than from the current template and sheet.
+    """
+    try:
+        options = request.get_json(silent=True) or {}
+        mode = options.get('mode', 'combined')
+        if options.get('output_id'):
+            inputs = session.get('last_batch_inputs')
+            if options['output_id'] != session.get('last_output_id') or not inputs:
+                return jsonify({'error': 'Batch not found'}), 404
+        else:
+            inputs = session
+        template_path = inputs.get('template_path')
+        excel_path = inputs.get('excel_path')
+        fields = inputs.get('fields', {})
         
-        df = pd.read_excel(excel_path)
+        if not template_path or not excel_path:
+            return jsonify({'error': 'Missing template or data'}), 400
+        if not os.path.exists(template_path) or not os.path.exists(excel_path):
+            return jsonify({'error': 'The template or data of this batch is no longer available'}), 404
+        if mode not in ('combined', 'separate'):
+            return jsonify({'error': f'Unknown PDF mode: {mode}'}), 400
         
-        # Create unique output folder
+        rows = renderer.certificate_rows(sheet_cache.load(excel_path, inputs.get('excel_hash')))
+        font_paths = renderer.default_font_paths(app.config['FONT_FOLDER'])
         output_id = str(uuid.uuid4())
-        output_dir = os.path.join(app.config['OUTPUT_FOLDER'], output_id)
-        os.makedirs(output_dir, exist_ok=True)
         
-        # Generate certificates
-        generated_files = []
-        for idx, row in df.iterrows():
-            cert = create_certificate(template_path, row, fields)
-            filename = f"certificate_{idx+1}_{str(row.iloc[0]).replace(' ', '_')[:30]}.png"
-            filepath = os.path.join(output_dir, filename)
-            cert.save(filepath)
-            generated_files.append(filename)
+        if mode == 'combined':
+            filename = f"certificates_{output_id}.pdf"
+            with sweeper.hold(template_path, excel_path), \
+                    metrics.timer('certgen_stage_seconds', stage='pdf_write'):
+                pdf_output.render_pdf(os.path.join(app.config['OUTPUT_FOLDER'], filename),
+                                      template_path, rows, fields, font_paths)
+        else:
+            filename = f"certificates_{output_id}_pdf.zip"
+            with sweeper.hold(template_path, excel_path), \
+                    metrics.timer('certgen_stage_seconds', stage='pdf_write'):
+                with zipfile.ZipFile(os.path.join(app.config['OUTPUT_FOLDER'], filename), 'w') as zipf:
+                    for pdf_name, data in pdf_output.iter_pdfs(template_path, rows, fields, font_paths):
+                        zipf.writestr(pdf_name, data)
+        metrics.inc('certgen_bytes_written_total',
+                    os.path.getsize(os.path.join(app.config['OUTPUT_FOLDER'], filename)))
         
-        session['last_output_id'] = output_id # Store output_id in session
-        session['last_generated_files'] = generated_files # Store generated filenames
+        return jsonify({
+            'success': True,
+            'count': len(rows),
+            'download_url': f"/download/{filename}"
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-        # Create zip file
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Queue certificate generation in the background and return its job id"""
+    template_path = session.get('template_path')
+    excel_path = session.get('excel_path')
+    fields = session.get('fields', {})
+    options = request.get_json(silent=True) or {}
+    
+    if not template_path or not excel_path:
+        return jsonify({'error': 'Missing template or data'}), 400
+    try:
+        output = requested_output(options)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    job_id = job_manager.submit(generate_batch, {
+        'template_path': template_path,
+        'excel_path': excel_path,
+        'excel_hash': session.get('excel_hash'),
+        'fields': fields,
+        'keep_files': options.get('keep_files', app.config['KEEP_LOOSE_FILES']),
+        'output': output,
+        'cache': requested_caching(options)
+    })
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status_url': f'/jobs/{job_id}',
+        'result_url': f'/jobs/{job_id}/result'
+    }), 202
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = job_manager.status(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    job.pop('params', None)
+    if job['result']:
+        job['result'] = {
+            'count': len(job['result']['generated_files']),
+            'download_url': f"/download/{job['result']['zip_filename']}",
+            'stats': job['result'].get('stats', {})
+        }
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    job = job_manager.status(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['state'] != 'done':
+        return jsonify({'error': f"Job is {job['state']}", 'state': job['state']}), 409
+    
+    # Make the finished batch the one the print view shows
+    remember_batch(job['result'], job['params'])
+    return download_file(job['result']['zip_filename'])
+
+def generate_batch(template_path, excel_path, fields, keep_files, excel_hash=None, output=None, cache=True,
+                   job=None):
+    """Render every row of the sheet into a new zip (and optionally loose files)"""
+    output = output or renderer.output_settings(app.config['OUTPUT_PRESET'])
+    df = sheet_cache.load(excel_path, excel_hash)
+    rows = renderer.certificate_rows(df, renderer.EXTENSIONS[output['format']])
+    # Fields that are the same on every certificate are drawn only once
+    constants = renderer.constant_columns(df, fields)
+    if job:
+        job.start(len(rows))
+    
+    # Create unique output folder
+    output_id = str(uuid.uuid4())
+    output_dir = os.path.join(app.config['OUTPUT_FOLDER'], output_id)
+    if keep_files:
+        os.makedirs(output_dir, exist_ok=True)
+    
+    zip_filename = f"certificates_{output_id}.zip"
+    zip_path = os.path.join(app.config['OUTPUT_FOLDER'], zip_filename)
+    
+    # Generate certificates straight into the zip file
+    generated_files = []
+    stats = {}
+    with sweeper.hold(template_path, excel_path, zip_path, output_dir):
+        with zipfile.ZipFile(zip_path, 'w') as zipf:
+            for filename, data in render_certificates(template_path, rows, fields, stats, constants, output,
+                                                      cache):
+                start = time.perf_counter()
+                zipf.writestr(filename, data)
+                if keep_files:
+                    with open(os.path.join(output_dir, filename), 'wb') as f:
+                        f.write(data)
+                write_seconds = time.perf_counter() - start
+                metrics.observe('certgen_stage_seconds', write_seconds, stage='zip_write')
+                metrics.inc('certgen_bytes_written_total', len(data) * (2 if keep_files else 1))
+                stats['zip_write'] = stats.get('zip_write', 0) + write_seconds
+                generated_files.append(filename)
+                if job:
+                    job.advance()
+    
+    # Rows whose certificate came from the render cache
+    stats['reused'] = len(generated_files) - stats.get('rows', 0)
+    return {
+        'output_id': output_id,
+        'output_dir': output_dir,
+        'zip_filename': zip_filename,
+        'generated_files': generated_files,
+        'stats': stats
+    }
+
+def remember_batch(result, inputs):
+    """Store a finished batch, and what it was made from, in the session for the print view"""
+    # The filenames are not stored: for a big batch they would overflow the
+    # session cookie. The print view reads them back from the batch instead.
+    session['last_output_id'] = result['output_id'] # Store output_id in session
+    session['last_zip'] = result['zip_filename']
+    session['last_output_dir'] = result['output_dir']
+    # So its PDF still matches it after a new template or sheet is uploaded
+    session['last_batch_inputs'] = {
+        'template_path': inputs.get('template_path'),
+        'excel_path': inputs.get('excel_path'),
+        'excel_hash': inputs.get('excel_hash'),
+        'fields': inputs.get('fields', {})
+    }
+
+@app.route('/stream_certificates')
+def stream_certificates():
+    """Stream the zip to the client while the certificates are still rendering"""
+    try:
+        template_path = session.get('template_path')
+        excel_path = session.get('excel_path')
+        fields = session.get('fields', {})
+        
+        if not template_path or not excel_path:
+            return jsonify({'error': 'Missing template or data'}), 400
+        try:
+            # A preset name in the query string, e.g. ?output=fast
+            output = requested_output(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # Holding the inputs marks them as recently used for the sweeper
+        with sweeper.hold(template_path, excel_path):
+            df = sheet_cache.load(excel_path, session.get('excel_hash'))
+        rows = renderer.certificate_rows(df, renderer.EXTENSIONS[output['format']])
+        output_id = str(uuid.uuid4())
         zip_filename = f"certificates_{output_id}.zip"
         zip_path = os.path.join(app.config['OUTPUT_FOLDER'], zip_filename)
         
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for filename in generated_files:
-                file_path = os.path.join(output_dir, filename)
-                zipf.write(file_path, filename)
-        
-        session['last_zip'] = zip_filename
-        session['last_output_dir'] = output_dir
+        # Filenames are known up front, so the session can be updated before
+        # the response body starts streaming
+        remember_batch({
+            'output_id': output_id,
+            'output_dir': os.path.join(app.config['OUTPUT_FOLDER'], output_id),
+            'zip_filename': zip_filename,
+            'generated_files': [filename for filename, _ in rows]
+        }, session)
         
-        return jsonify({
-            'success': True,
-            'count': len(generated_files),
-            'download_url': f'/download/{zip_filename}'
-        })
+        chunks = renderer.stream_zip(render_certificates(
+            template_path, rows, fields, constants=renderer.constant_columns(df, fields), output=output,
+            cache=requested_caching(request.args)))
+        return Response(save_while_streaming(chunks, zip_path), mimetype='application/zip',
+                        headers={'Content-Disposition': f'attachment; filename={zip_filename}'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def render_certificates(template_path, rows, fields, stats=None, constants=None, output=None, cache=True):
+    """Yield (filename, image_bytes) for every row, in order, reusing earlier renders if cache is set"""
+    return (render_cache.iter_rendered if cache else renderer.iter_rendered)(
+        template_path, rows, fields,
+        renderer.default_font_paths(app.config['FONT_FOLDER']),
+        workers=app.config['RENDER_WORKERS'], stats=stats, constants=constants, output=output
+    )
+
+def save_while_streaming(chunks, path):
+    """Pass chunks through while keeping a copy at path once they are all sent"""
+    partial_path = path + '.part'
+    complete = False
+    try:
+        with open(partial_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                metrics.inc('certgen_bytes_written_total', len(chunk))
+                yield chunk
+        complete = True
+        os.replace(partial_path, path)
+    finally:
+        # The client went away before the archive was finished
+        if not complete and os.path.exists(partial_path):
+            os.remove(partial_path)
+
+@lru_cache(maxsize=4096)
+def _file_digest(path, mtime_ns, size):
+    return datasource.file_hash(path)
+
+def content_etag(path):
+    """SHA-256 of a file's content, hashed once for as long as its mtime and size stay the same"""
+    stat = os.stat(path)
+    return _file_digest(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+def send_output(source, etag=None, **kwargs):
+    """send_file for files named by a uuid or content hash, which never change once written.
+
+    The strong ETag comes from the content (of a path, unless etag is
+    given), so revalidation gets a 304. Byte ranges let interrupted
+    downloads resume, and browsers may keep the response for good.
+    """
+    if etag is None:
+        etag = content_etag(source)
+    response = send_file(source, etag=etag, conditional=True,
+                         max_age=app.config['OUTPUT_CACHE_SECONDS'], **kwargs)
+    # Certificates carry personal details; keep them out of shared caches
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
 @app.route('/download/<filename>')
 def download_file(filename):
     filepath = os.path.join(app.config['OUTPUT_FOLDER'], filename)
     if os.path.exists(filepath):
-        return send_file(filepath, as_attachment=True, download_name=filename)
+        return send_output(filepath, as_attachment=True, download_name=filename)
     return jsonify({'error': 'File not found'}), 404
 
 @app.route('/print_certificates')
 def print_certificates():
-    """Route to display all generated certificates for printing"""
+    """Show the last batch for printing, a page of print-size images at a time"""
     try:
         output_id = session.get('last_output_id')
-        generated_files = session.get('last_generated_files')
+        generated_files = batch_files(output_id) if output_id else []
 
-        if not output_id or not generated_files:
+        if not generated_files:
             return "No certificates generated yet. Please generate certificates first.", 400
 
+        per_page = app.config['PRINT_PAGE_SIZE']
+        pages = math.ceil(len(generated_files) / per_page)
+        page = min(max(1, request.args.get('page', 1, type=int)), pages)
+        first = (page - 1) * per_page
         certificate_urls = [
-            f'/display_certificate/{output_id}/{filename}'
-            for filename in generated_files
+            f"/display_certificate/{output_id}/{filename}?width={app.config['PRINT_WIDTH']}"
+            for filename in generated_files[first:first + per_page]
         ]
         
-        return render_template('print_view.html', certificate_urls=certificate_urls)
+        return render_template('print_view.html', certificate_urls=certificate_urls, output_id=output_id,
+                               page=page, pages=pages, first=first + 1, total=len(generated_files))
     except Exception as e:
         return f"Error generating print view: {str(e)}", 500
 
-@app.route('/display_certificate/<output_id>/<filename>')
-def display_certificate(output_id, filename):
+def batch_files(output_id):
+    """Filenames of a finished batch, in order, from its zip or loose files"""
+    zip_path = os.path.join(app.config['OUTPUT_FOLDER'], f"certificates_{output_id}.zip")
+    if os.path.exists(zip_path):
+        with zipfile.ZipFile(zip_path) as zipf:
+            return zipf.namelist()
+    output_dir = os.path.join(app.config['OUTPUT_FOLDER'], output_id)
+    if os.path.isdir(output_dir):
+        return sorted((name for name in os.listdir(output_dir)
+                       if os.path.isfile(os.path.join(output_dir, name))),
+                      key=lambda name: int(name.split('_')[1]) if name.split('_')[1].isdigit() else 0)
+    return []
+
+def certificate_source(output_id, filename):
+    """The full-size certificate as a path or file object, or None if it is gone"""
     filepath = os.path.join(app.config['OUTPUT_FOLDER'], output_id, filename)
     if os.path.exists(filepath):
-        return send_file(filepath, mimetype='image/png')
-    return jsonify({'error': 'Certificate not found'}), 404
+        return filepath
+    
+    # Without loose files the certificate only lives inside the batch zip
+    zip_path = os.path.join(app.config['OUTPUT_FOLDER'], f"certificates_{output_id}.zip")
+    if os.path.exists(zip_path):
+        with zipfile.ZipFile(zip_path) as zipf:
+            if filename in zipf.namelist():
+                return BytesIO(zipf.read(filename))
+    return None
 
-def create_certificate(template_path, row_data, fields):
-    """Create a certificate image with data filled in"""
-    img = Image.open(template_path)
-    draw = ImageDraw.Draw(img)
+def print_rendition(output_id, filename, width):
+    """Path of a JPEG of the certificate scaled down to width, made on first request"""
+    folder = os.path.join(app.config['OUTPUT_FOLDER'], output_id, f"print_{width}")
+    path = os.path.join(folder, os.path.splitext(filename)[0] + '.jpg')
+    if os.path.exists(path):
+        return path
     
-    for column, field_data in fields.items():
-        x = field_data.get('x')
-        y = field_data.get('y')
-        font_size = field_data.get('fontSize', 40)
-        
-        if x is None or y is None:
-            continue
-        
-        text = str(row_data.get(column, ''))
-        
-        font = ImageFont.load_default() # Fallback to default
+    source = certificate_source(output_id, filename)
+    if source is None:
+        return None
+    with Image.open(source) as img:
+        if img.width > width:
+            img = img.resize((width, max(1, round(img.height * width / img.width))),
+                             Image.Resampling.LANCZOS, reducing_gap=3.0)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        os.makedirs(folder, exist_ok=True)
+        atomic_write(path, lambda f: img.save(f, 'JPEG', quality=90))
+    return path
 
-        try:
-            # Try to load Arial.ttf first
-            arial_font_path = os.path.join(os.environ.get('WINDIR', 'C:/Windows'), 'Fonts', 'arial.ttf')
-            if os.path.exists(arial_font_path):
-                font = ImageFont.truetype(arial_font_path, font_size)
-            else:
-                # Fallback to the provided custom fonts if Arial is not found
-                custom_font_path1 = os.path.join(app.config['FONT_FOLDER'], "Emotional Rescue Personal Use.ttf")
-                if os.path.exists(custom_font_path1):
-                    font = ImageFont.truetype(custom_font_path1, font_size)
-                else:
-                    custom_font_path2 = os.path.join(app.config['FONT_FOLDER'], "FontsFree-Net-GOTHICB0.ttf")
-                    if os.path.exists(custom_font_path2):
-                        font = ImageFont.truetype(custom_font_path2, font_size)
-
-        except Exception as e:
-            print(f"Error loading font: {e}. Using default font.")
-
-        draw.text((x, y), text, fill='black', font=font)
+@app.route('/display_certificate/<output_id>/<filename>')
+def display_certificate(output_id, filename):
+    try:
+        uuid.UUID(output_id)
+    except ValueError:
+        return jsonify({'error': 'Certificate not found'}), 404
+    
+    # ?width= asks for a smaller JPEG, e.g. for the print view
+    width = request.args.get('width', type=int)
+    if width:
+        widths = sorted(app.config['PRINT_WIDTHS'])
+        width = next((allowed for allowed in widths if allowed >= width), widths[-1])
+        path = print_rendition(output_id, filename, width)
+        if path:
+            return send_output(path)
+        return jsonify({'error': 'Certificate not found'}), 404
     
-    return img
+    source = certificate_source(output_id, filename)
+    if source is None:
+        return jsonify({'error': 'Certificate not found'}), 404
+    if isinstance(source, BytesIO):
+        # Read out of the batch zip, so it is already in memory to hash
+        return send_output(source, etag=hashlib.sha256(source.getbuffer()).hexdigest(),
+                           download_name=filename)
+    return send_output(source, download_name=filename)
+
+def create_certificate(template_path, row_data, fields, width=None):
+    """Create a certificate image with data filled in, optionally scaled to width"""
+    img = renderer.template_cache.copy(template_path, width)
+    scale = 1.0
+    if width:
+        # Only reads the header, the full-size pixels are never decoded
+        with Image.open(template_path) as full_size:
+            scale = img.width / full_size.width
+    get_font = renderer.font_loader(renderer.default_font_paths(app.config['FONT_FOLDER']))
+    return renderer.draw_fields(img, row_data, fields, get_font, scale=scale)
 
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
\ No newline at end of file
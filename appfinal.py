@@ -1,8 +1,83 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
-from PIL import Image, ImageDraw, ImageFont, ImageTk
+from PIL import Image, ImageDraw, ImageTk
 import pandas as pd
 import os
+import queue
+import threading
+import time
+import renderer
+from fonts import registry as font_registry
+
+# Fonts tried for certificate text, in order of preference
+CERTIFICATE_FONT = 'appfinal-certificate'
+FONT_PATHS = [
+    "arial.ttf",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+]
+font_registry.register(CERTIFICATE_FONT, FONT_PATHS)
+
+# Milliseconds the canvas must stop resizing for before the template is redrawn
+RESIZE_DELAY = 100
+
+class GenerationThread(threading.Thread):
+    """Renders and saves a batch away from the Tk main loop.
+
+    The rows are rendered on the renderer's process pool. The thread never
+    touches a widget; it puts ('progress', done), then ('done', done),
+    ('cancelled', done) or ('error', message) on `messages` for the GUI to
+    poll with root.after. While paused it stops taking certificates, so the
+    pool goes idle once the few chunks already submitted are rendered.
+    """
+
+    def __init__(self, template_path, rows, fields, output_dir, constants=None, workers=None):
+        super().__init__(daemon=True)
+        self.template_path = template_path
+        self.rows = rows
+        self.fields = fields
+        self.output_dir = output_dir
+        self.constants = constants
+        self.workers = workers or os.cpu_count() or 1
+        self.total = len(rows)
+        self.messages = queue.Queue()
+        self._cancelled = threading.Event()
+        self._running = threading.Event()
+        self._running.set()
+
+    def pause(self):
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    def cancel(self):
+        self._cancelled.set()
+        self._running.set()
+
+    @property
+    def paused(self):
+        return not self._running.is_set()
+
+    def run(self):
+        done = 0
+        certificates = renderer.iter_rendered(self.template_path, self.rows, self.fields, FONT_PATHS,
+                                              workers=self.workers, constants=self.constants)
+        try:
+            for filename, data in certificates:
+                with open(os.path.join(self.output_dir, filename), 'wb') as f:
+                    f.write(data)
+                done += 1
+                self.messages.put(('progress', done))
+                self._running.wait()
+                if self._cancelled.is_set():
+                    break
+        except Exception as e:
+            self.messages.put(('error', str(e)))
+            return
+        finally:
+            # Cancels whatever the pool has not rendered yet
+            certificates.close()
+        self.messages.put(('cancelled' if self._cancelled.is_set() else 'done', done))
 
 class CertificateGenerator:
     def __init__(self, root):
@@ -13,11 +88,15 @@ class CertificateGenerator:
         self.template_path = None
         self.excel_path = None
         self.template_image = None
+        self.scaled_template_image = None
+        self.template_levels = []
         self.display_image = None
+        self.resize_job = None
         self.fields = {}
         self.excel_data = None
         self.current_column = None
         self.scale_factor = 1.0
+        self.generation = None
         
         self.setup_ui()
 
@@ -146,7 +225,10 @@ class CertificateGenerator:
         right_frame.columnconfigure(0, weight=1)
     
     def on_canvas_resize(self, event):
-        self.display_template()
+        # Dragging the window edge fires a burst of these; redraw once it settles
+        if self.resize_job is not None:
+            self.root.after_cancel(self.resize_job)
+        self.resize_job = self.root.after(RESIZE_DELAY, self.display_template)
     
     def load_template(self):
         filepath = filedialog.askopenfilename(
@@ -157,10 +239,34 @@ class CertificateGenerator:
             self.template_path = filepath
             self.template_label.config(text=f"✓ {os.path.basename(filepath)}")
             self.template_image = Image.open(filepath)
+            self.scaled_template_image = None
+            display_base = self.template_image
+            if display_base.mode not in ('RGB', 'RGBA', 'L'):
+                display_base = display_base.convert('RGBA')
+            self.template_levels = [display_base]
+            self.display_image = None
             self.display_template()
             messagebox.showinfo("Success", "Template loaded successfully!")
     
+    def display_level(self, width):
+        """The smallest level of the template pyramid that is at least width pixels wide.
+
+        Each level is half the size of the one before, averaged down with
+        reduce(2), and is made the first time it is needed. Scaling from the
+        nearest level touches at most four pixels per displayed one, however
+        large the template is.
+        """
+        index = 0
+        while True:
+            level = self.template_levels[index]
+            if level.width // 2 < width or level.height < 2:
+                return level
+            if index + 1 == len(self.template_levels):
+                self.template_levels.append(level.reduce(2))
+            index += 1
+    
     def display_template(self):
+        self.resize_job = None
         self.canvas.delete('all') # Clear existing image and markers
 
         if not self.template_image:
@@ -193,9 +299,14 @@ class CertificateGenerator:
             # Avoid issues with very small or zero-sized images after scaling
             return
 
-        self.display_image = self.template_image.resize((new_width, new_height), 
-                                                        Image.Resampling.LANCZOS)
-        self.photo_image = ImageTk.PhotoImage(self.display_image)
+        if self.display_image is None or self.display_image.size != (new_width, new_height):
+            level = self.display_level(new_width)
+            if level.size == (new_width, new_height):
+                self.display_image = level
+            else:
+                # Less than 2x away from the target, so a bilinear pass is enough
+                self.display_image = level.resize((new_width, new_height), Image.Resampling.BILINEAR)
+            self.photo_image = ImageTk.PhotoImage(self.display_image)
         
         # Calculate position to center the image on the canvas
         x_center = (canvas_width - new_width) // 2
@@ -359,8 +470,11 @@ class CertificateGenerator:
                 self.canvas.delete(item)
             field['marker'] = None
     
-    def create_certificate(self, row_data):
-        cert = self.template_image.copy()
+    def create_certificate(self, row_data, scale=1.0):
+        if scale == 1.0:
+            cert = self.template_image.copy()
+        else:
+            cert = self.scaled_template(scale).copy()
         draw = ImageDraw.Draw(cert)
         
         for column, field in self.fields.items():
@@ -368,25 +482,27 @@ class CertificateGenerator:
                 continue
             
             try:
-                x = field['x']
-                y = field['y']
-                font_size = int(field['font_size'].get())
+                x = field['x'] * scale
+                y = field['y'] * scale
+                font_size = max(1, round(int(field['font_size'].get()) * scale))
                 text = str(row_data[column])
                 
-                try:
-                    font = ImageFont.truetype("arial.ttf", font_size)
-                except:
-                    try:
-                        font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", font_size)
-                    except:
-                        font = ImageFont.load_default()
-                
+                font = font_registry.get(CERTIFICATE_FONT, font_size)
                 draw.text((x, y), text, fill='black', font=font)
             except Exception as e:
                 print(f"Error drawing field {column}: {e}")
         
         return cert
     
+    def scaled_template(self, scale):
+        """Template resized by scale, kept until the next template is loaded"""
+        size = (max(1, round(self.template_image.width * scale)),
+                max(1, round(self.template_image.height * scale)))
+        if self.scaled_template_image is None or self.scaled_template_image.size != size:
+            self.scaled_template_image = self.template_image.resize(
+                size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+        return self.scaled_template_image
+    
     def preview_certificate(self):
         if not self.validate_inputs():
             return
@@ -400,17 +516,12 @@ class CertificateGenerator:
         preview_window.title("Certificate Preview")
         preview_window.geometry("900x700")
         
-        # Use first row for preview
+        # Use first row for preview, rendered directly at preview size
         preview_data = self.excel_data.iloc[0]
-        cert_image = self.create_certificate(preview_data)
-        
-        # Resize for preview
         preview_width = 850
-        aspect_ratio = cert_image.height / cert_image.width
-        preview_height = int(preview_width * aspect_ratio)
-        
-        cert_image = cert_image.resize((preview_width, preview_height), 
-                                      Image.Resampling.LANCZOS)
+        cert_image = self.create_certificate(preview_data,
+                                             scale=preview_width / self.template_image.width)
+        preview_height = cert_image.height
         
         canvas = tk.Canvas(preview_window, width=preview_width, height=preview_height)
         canvas.pack(padx=20, pady=20)
@@ -422,49 +533,113 @@ class CertificateGenerator:
         ttk.Label(preview_window, text="Preview of first certificate", 
                  font=('Arial', 12)).pack(pady=10)
     
+    def field_snapshot(self):
+        """Placed fields as plain data, safe to hand to another thread or process"""
+        fields = {}
+        for column, field in self.fields.items():
+            if field['x'] is None or field['y'] is None:
+                continue
+            try:
+                font_size = int(field['font_size'].get())
+            except ValueError:
+                raise ValueError(f"Font size of {column} must be a whole number")
+            fields[column] = {'x': field['x'], 'y': field['y'], 'fontSize': font_size}
+        return fields
+    
     def generate_certificates(self):
+        if self.generation is not None and self.generation.is_alive():
+            messagebox.showwarning("Warning", "Certificates are already being generated!")
+            return
         if not self.validate_inputs():
             return
+        try:
+            fields = self.field_snapshot()
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
         
         output_dir = filedialog.askdirectory(title="Select Output Folder for Certificates")
         if not output_dir:
             return
         
+        progress_window = tk.Toplevel(self.root)
+        progress_window.title("Generating Certificates")
+        progress_window.geometry("400x180")
+        
+        ttk.Label(progress_window, text="Generating certificates...", 
+                 font=('Arial', 12)).pack(pady=15)
+        
+        progress = ttk.Progressbar(progress_window, length=300, mode='determinate')
+        progress.pack(pady=5)
+        
+        status_label = ttk.Label(progress_window, text="")
+        status_label.pack(pady=5)
+        
+        buttons = ttk.Frame(progress_window)
+        buttons.pack(pady=5)
+        pause_button = ttk.Button(buttons, text="Pause")
+        pause_button.grid(row=0, column=0, padx=5)
+        ttk.Button(buttons, text="Cancel", command=self.cancel_generation).grid(row=0, column=1, padx=5)
+        
+        def toggle_pause():
+            if self.generation.paused:
+                self.generation.resume()
+                pause_button.config(text="Pause")
+            else:
+                self.generation.pause()
+                pause_button.config(text="Resume")
+        pause_button.config(command=toggle_pause)
+        progress_window.protocol("WM_DELETE_WINDOW", self.cancel_generation)
+        
+        rows = renderer.certificate_rows(self.excel_data)
+        progress['maximum'] = len(rows)
+        self.generation = GenerationThread(self.template_path, rows, fields, output_dir,
+                                           constants=renderer.constant_columns(self.excel_data, fields))
+        self.generation.start()
+        self.poll_generation(self.generation, progress_window, progress, status_label,
+                             output_dir, time.perf_counter())
+    
+    def cancel_generation(self):
+        if self.generation is not None:
+            self.generation.cancel()
+    
+    def poll_generation(self, worker, progress_window, progress, status_label, output_dir, started):
+        """Show the worker's progress, checking again shortly until it finishes"""
+        result = None
+        done = progress['value']
         try:
-            progress_window = tk.Toplevel(self.root)
-            progress_window.title("Generating Certificates")
-            progress_window.geometry("400x150")
-            
-            ttk.Label(progress_window, text="Generating certificates...", 
-                     font=('Arial', 12)).pack(pady=20)
-            
-            progress = ttk.Progressbar(progress_window, length=300, mode='determinate')
-            progress.pack(pady=10)
-            
-            status_label = ttk.Label(progress_window, text="")
-            status_label.pack(pady=10)
-            
-            total = len(self.excel_data)
-            progress['maximum'] = total
-            
-            for idx, row in self.excel_data.iterrows():
-                cert = self.create_certificate(row)
-                
-                # Use first column value for filename
-                filename = f"certificate_{idx+1}_{str(row.iloc[0]).replace(' ', '_')[:30]}.png"
-                filepath = os.path.join(output_dir, filename)
-                cert.save(filepath)
-                
-                progress['value'] = idx + 1
-                status_label.config(text=f"Generated {idx+1} of {total}")
-                progress_window.update()
-            
-            progress_window.destroy()
+            while True:
+                kind, value = worker.messages.get_nowait()
+                if kind == 'progress':
+                    done = value
+                else:
+                    result = (kind, value)
+        except queue.Empty:
+            pass
+        
+        total = worker.total
+        rate = done / (time.perf_counter() - started)
+        progress['value'] = done
+        status = f"Generated {int(done)} of {total} ({rate:.1f}/s)"
+        status_label.config(text=status + (" - paused" if worker.paused else ""))
+        
+        if result is None:
+            self.root.after(100, self.poll_generation, worker, progress_window, progress,
+                            status_label, output_dir, started)
+            return
+        
+        progress_window.destroy()
+        kind, value = result
+        if kind == 'done':
             messagebox.showinfo("Success!", 
-                f"✓ Successfully generated {total} certificates!\n\n"
+                f"✓ Successfully generated {value} certificates!\n\n"
                 f"Saved to: {output_dir}")
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to generate certificates:\n{str(e)}")
+        elif kind == 'cancelled':
+            messagebox.showinfo("Cancelled", 
+                f"Generation cancelled after {value} of {total} certificates.\n\n"
+                f"Saved to: {output_dir}")
+        else:
+            messagebox.showerror("Error", f"Failed to generate certificates:\n{value}")
     
     def validate_inputs(self):
         if not self.template_path:
@@ -1,10 +1,13 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
 import openpyxl
 import os
 import sys
 from datetime import datetime
+from fonts import registry as font_registry
+from textfit import fitter as text_fitter
+from pdf_output import PdfDocument
 
 # ✅ Helper: handle relative paths for fonts (PyInstaller friendly)
 def resource_path(relative_path):
@@ -16,43 +19,16 @@ def resource_path(relative_path):
 
 # ✅ Load font safely
 def load_font(font_file, size):
-    paths_to_try = [
+    font_registry.register(font_file, [
         resource_path(font_file),
         os.path.join("C:\\Windows\\Fonts", font_file),
         os.path.join("C:\\Windows\\Fonts", font_file.replace('.ttf', '.TTF'))
-    ]
-    
-    for path in paths_to_try:
-        if os.path.exists(path):
-            return ImageFont.truetype(path, size)
-    
-    print(f"Warning: Font file '{font_file}' not found. Using default font.")
-    return ImageFont.load_default()
+    ])
+    return font_registry.get(font_file, size)
 
 # ✅ Smart text wrapping function
 def wrap_text(text, font, max_width, draw):
-    words = text.split()
-    lines = []
-    current_line = []
-    
-    for word in words:
-        test_line = ' '.join(current_line + [word])
-        bbox = draw.textbbox((0, 0), test_line, font=font)
-        width = bbox[2] - bbox[0]
-        
-        if width <= max_width:
-            current_line.append(word)
-        else:
-            if current_line:
-                lines.append(' '.join(current_line))
-                current_line = [word]
-            else:
-                lines.append(word)
-    
-    if current_line:
-        lines.append(' '.join(current_line))
-    
-    return lines
+    return text_fitter.wrap(text, font, max_width)
 
 # ✅ Draw multi-line text
 def draw_multiline_text(draw, lines, start_x, start_y, font, fill, line_spacing=5):
@@ -95,7 +71,7 @@ def generate_certificates(template_path, excel_path, output_dir, save_format):
         font_dates = load_font("times.ttf", 28)
 
         # Load Excel
-        workbook = openpyxl.load_workbook(excel_path)
+        workbook = openpyxl.load_workbook(excel_path, read_only=True)
         sheet = workbook.active
 
         os.makedirs(output_dir, exist_ok=True)
@@ -112,6 +88,10 @@ def generate_certificates(template_path, excel_path, output_dir, save_format):
 
         certificates_generated = 0
 
+        # PDFs share the template image and draw the text as real text
+        pdf_mode = save_format.upper() in ("PDF", "COMBINED PDF")
+        combined = PdfDocument(template_path, resolution=100.0) if save_format.upper() == "COMBINED PDF" else None
+
         # Iterate through each row (skip header)
         for row in sheet.iter_rows(min_row=2, values_only=True):
             if not row or len(row) < 8:
@@ -129,8 +109,12 @@ def generate_certificates(template_path, excel_path, output_dir, save_format):
             if not (student_name and course_name):
                 continue
 
-            cert_image = template.copy()
-            draw = ImageDraw.Draw(cert_image)
+            if pdf_mode:
+                document = combined or PdfDocument(template_path, resolution=100.0)
+                draw = document.add_page()
+            else:
+                cert_image = template.copy()
+                draw = ImageDraw.Draw(cert_image)
 
             # 📌 COORDINATES (Certificate No REMOVED)
             name_position = (400, 275)
@@ -175,7 +159,7 @@ def generate_certificates(template_path, excel_path, output_dir, save_format):
             # Save file
             safe_name = str(student_name).replace(" ", "_").replace("/", "-").replace(":", "-").replace("\\", "-")
             filename = f"{safe_name}"
-            ext = "pdf" if save_format.upper() == "PDF" else "png"
+            ext = "pdf" if pdf_mode else "png"
             out_path = os.path.join(output_dir, f"{filename}.{ext}")
 
             counter = 1
@@ -183,14 +167,19 @@ def generate_certificates(template_path, excel_path, output_dir, save_format):
                 out_path = os.path.join(output_dir, f"{safe_name}_{counter}.{ext}")
                 counter += 1
 
-            if save_format.upper() == "PDF":
-                cert_image.save(out_path, "PDF", resolution=100.0)
+            if combined is not None:
+                pass  # Saved once all pages are drawn
+            elif pdf_mode:
+                document.save(out_path)
             else:
                 cert_image.save(out_path, "PNG")
             
             certificates_generated += 1
             print(f"Generated: {filename}")
 
+        workbook.close()
+        if combined is not None:
+            combined.save(os.path.join(output_dir, "certificates.pdf"))
         messagebox.showinfo("Success", f"✅ {certificates_generated} Certificate(s) generated successfully!")
         
     except Exception as e:
@@ -239,7 +228,7 @@ tk.Button(frame, text="Browse", command=lambda: select_directory(output_dir_entr
 
 # Format
 tk.Label(frame, text="Save Format:").grid(row=3, column=0, sticky="e", padx=5, pady=5)
-format_options = ["PDF", "Image"]
+format_options = ["PDF", "Combined PDF", "Image"]
 format_var = tk.StringVar(value=format_options[0])
 format_menu = tk.OptionMenu(frame, format_var, *format_options)
 format_menu.grid(row=3, column=1, sticky="w")
@@ -0,0 +1,146 @@
+"""Generate certificates from the command line, without the web app or a GUI.
+
+The field layout is a JSON file holding either a single layout (the `fields`
+dict the web app saves) or several keyed by template, like coordinates.json.
+
+    python batch_generate.py --template template2.jpg --data students.xlsx \\
+        --fields coordinates.json --layout updatedtemp.jpeg --output certificates.zip
+    python batch_generate.py --template template2.jpg --data students.csv \\
+        --fields fields.json --output out/ --workers 8
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import zipfile
+from itertools import chain, islice
+import datasource
+import renderer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Rows read ahead to guess which fields are the same on every certificate
+CONSTANT_SAMPLE_ROWS = 64
+
+def load_fields(path, layout=None):
+    """Read a field layout from path, picking `layout` out of a coordinates file"""
+    with open(path) as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError(f"{path} does not hold a field layout")
+
+    # A plain layout maps columns straight to their {x, y, fontSize}
+    if all(isinstance(field, dict) and 'x' in field for field in data.values()):
+        if layout:
+            raise ValueError(f"{path} holds a single layout; drop --layout")
+        return data
+
+    if layout is None:
+        if len(data) != 1:
+            raise ValueError(f"{path} holds several layouts; pick one with --layout: "
+                             + ", ".join(sorted(data)))
+        layout = next(iter(data))
+    if layout not in data:
+        raise ValueError(f"No layout '{layout}' in {path}")
+    return data[layout]
+
+def write_zip(path, certificates):
+    """Write certificates into a zip at path, replacing it only once complete"""
+    partial_path = path + '.part'
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    count = 0
+    try:
+        with zipfile.ZipFile(partial_path, 'w') as zipf:
+            for filename, data in certificates:
+                zipf.writestr(filename, data)
+                count += 1
+        os.replace(partial_path, path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    return count
+
+def write_folder(path, certificates):
+    os.makedirs(path, exist_ok=True)
+    count = 0
+    for filename, data in certificates:
+        with open(os.path.join(path, filename), 'wb') as f:
+            f.write(data)
+        count += 1
+    return count
+
+def output_spec(args):
+    """The --preset plus any encoder settings given on the command line"""
+    spec = {'preset': args.preset}
+    if args.format:
+        spec['format'] = args.format
+    if args.quality is not None:
+        spec['quality'] = args.quality
+    if args.compress_level is not None:
+        spec['compress_level'] = args.compress_level
+    if args.lossless:
+        spec['lossless'] = True
+    return spec
+
+def run(args):
+    fields = load_fields(args.fields, args.layout)
+    output = renderer.output_settings(output_spec(args))
+    font_paths = args.font + renderer.default_font_paths(os.path.join(HERE, 'static', 'fonts'))
+
+    start = time.perf_counter()
+    # Fields that are the same across the first rows are drawn once instead
+    # of on every row; a later row that differs is just drawn in full. The
+    # file is read once, and rendering starts after the first few rows.
+    rows = datasource.iter_rows(args.data)
+    head = list(islice(rows, CONSTANT_SAMPLE_ROWS))
+    constants = renderer.constant_values(head, fields)
+    rows = renderer.name_rows(chain(head, rows), renderer.EXTENSIONS[output['format']])
+    certificates = renderer.iter_rendered(args.template, rows, fields, font_paths,
+                                          workers=args.workers, constants=constants, output=output)
+    if args.output.lower().endswith('.zip'):
+        count = write_zip(args.output, certificates)
+    else:
+        count = write_folder(args.output, certificates)
+    seconds = time.perf_counter() - start
+
+    rate = count / seconds if seconds > 0 else 0
+    print(f"Generated {count} certificates into {args.output} "
+          f"in {seconds:.1f}s ({rate:.1f}/s, {args.workers} worker(s))")
+    return count
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate certificates without the web app")
+    parser.add_argument('--template', required=True, help="certificate template image")
+    parser.add_argument('--data', required=True, help="spreadsheet (.xlsx), .csv or .parquet file with one row per certificate")
+    parser.add_argument('--fields', required=True,
+                        help="field layout JSON, either a fields dict or a coordinates.json-style file")
+    parser.add_argument('--layout', help="key of the layout to use when --fields holds several")
+    parser.add_argument('--output', required=True,
+                        help="folder for the certificate images, or a path ending in .zip for an archive")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="rendering processes (default: one per CPU)")
+    parser.add_argument('--font', action='append', default=[],
+                        help="font file to try before the defaults; may be repeated")
+    parser.add_argument('--preset', default=renderer.DEFAULT_PRESET, choices=sorted(renderer.OUTPUT_PRESETS),
+                        help="encoder preset: 'fast' for speed, 'archival' for the smallest PNGs")
+    parser.add_argument('--format', choices=['png', 'jpeg', 'webp'],
+                        help="image format, overriding the preset's")
+    parser.add_argument('--quality', type=int, help="JPEG/WebP quality")
+    parser.add_argument('--compress-level', type=int, help="PNG zlib level, 0 (fastest) to 9")
+    parser.add_argument('--lossless', action='store_true', help="lossless WebP")
+    args = parser.parse_args(argv)
+
+    for path in (args.template, args.data, args.fields):
+        if not os.path.isfile(path):
+            parser.error(f"no such file: {path}")
+
+    try:
+        run(args)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
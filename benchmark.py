@@ -0,0 +1,231 @@
+"""Benchmark the certificate rendering pipeline.
+
+Uses the bundled sample data to time every stage of producing a
+certificate (spreadsheet parse, template decode, font load, text drawing,
+image encoding and zip writing), compares the encode cost of the output
+presets, then measures end-to-end throughput of the batch renderer at
+several synthetic batch sizes.
+
+    python benchmark.py
+    python benchmark.py --rows 100 1000 --workers 4 --json results.json
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+import zipfile
+from PIL import Image, ImageDraw
+import pandas as pd
+import renderer
+from fonts import registry
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def reset_peak_rss():
+    """Restart this process's peak resident memory from its current size (Linux only)"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def peak_rss_mb(pid='self'):
+    """Peak resident memory of a process in MB, from /proc; None where that is unavailable"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def pool_peak_rss_mb(workers):
+    """Summed peak resident memory of the render pool's worker processes, in MB"""
+    if workers <= 1:
+        return 0
+    # ProcessPoolExecutor keeps its live workers by pid
+    pids = list(getattr(renderer.get_pool(workers), '_processes', None) or {})
+    peaks = [peak_rss_mb(pid) for pid in pids]
+    return sum(peaks) if None not in peaks else None
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+def synthetic_rows(df, count):
+    """Cycle the sample rows up to count, making each name unique"""
+    records = df.to_dict('records')
+    name_column = 'Name' if 'Name' in df.columns else df.columns[0]
+    rows = []
+    for i in range(count):
+        row = dict(records[i % len(records)])
+        row[name_column] = f"{row[name_column]} {i + 1}"
+        filename = f"certificate_{i+1}_{str(next(iter(row.values()))).replace(' ', '_')[:30]}.png"
+        rows.append((filename, row))
+    return rows
+
+def time_cold_stages(args, fields, font_paths):
+    """Time the one-off stages: parse, decode and first font loads"""
+    start = time.perf_counter()
+    df = pd.read_excel(args.data)
+    excel_parse = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with Image.open(args.template) as img:
+        img.load()
+    template_decode = time.perf_counter() - start
+
+    registry.register(renderer.CERTIFICATE_FONT, font_paths)
+    start = time.perf_counter()
+    for field_data in fields.values():
+        registry.get(renderer.CERTIFICATE_FONT, field_data.get('fontSize', 40))
+    font_load = time.perf_counter() - start
+
+    return df, {
+        'excel_parse': excel_parse,
+        'template_decode': template_decode,
+        'font_load': font_load,
+    }
+
+def time_row_stages(args, rows, fields, font_paths):
+    """Render rows one at a time in-process, timing every stage of each row"""
+    get_font = renderer.font_loader(font_paths)
+    stages = {'template_copy': [], 'font_lookup': [], 'text_draw': [], 'encode': [], 'zip_write': []}
+    totals = []
+
+    with tempfile.TemporaryFile() as archive, zipfile.ZipFile(archive, 'w') as zipf:
+        for filename, row_data in rows:
+            t0 = time.perf_counter()
+            img = renderer.template_cache.copy(args.template)
+            t1 = time.perf_counter()
+            layout = list(renderer.layout_fields(row_data, fields, get_font))
+            t2 = time.perf_counter()
+            draw = ImageDraw.Draw(img)
+            for _, xy, text, font in layout:
+                renderer.text_cache.draw(draw, xy, text, font)
+            t3 = time.perf_counter()
+            data = renderer.encode_image(img, args.output)
+            t4 = time.perf_counter()
+            zipf.writestr(filename, data)
+            t5 = time.perf_counter()
+
+            for stage, seconds in zip(stages, (t1 - t0, t2 - t1, t3 - t2, t4 - t3, t5 - t4)):
+                stages[stage].append(seconds)
+            totals.append(t5 - t0)
+
+    return stages, totals
+
+def time_pipeline(args, rows, fields, font_paths):
+    """Run the real batch renderer and return (seconds, bytes written)"""
+    start = time.perf_counter()
+    written = 0
+    with tempfile.TemporaryFile() as archive, zipfile.ZipFile(archive, 'w') as zipf:
+        for filename, data in renderer.iter_rendered(args.template, rows, fields, font_paths,
+                                                     workers=args.workers, output=args.output):
+            zipf.writestr(filename, data)
+            written += len(data)
+    return time.perf_counter() - start, written
+
+def time_presets(args, rows, fields, font_paths, repeat=3):
+    """Encode one certificate with every preset; returns {preset: (ms, KB)}"""
+    img = renderer.draw_fields(renderer.template_cache.copy(args.template), rows[0][1], fields,
+                               renderer.font_loader(font_paths))
+    results = {}
+    for preset in args.presets:
+        settings = renderer.output_settings(preset)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            data = renderer.encode_image(img, settings)
+        results[preset] = ((time.perf_counter() - start) / repeat * 1000, len(data) / 1024)
+    return results
+
+def run(args):
+    with open(args.coordinates) as f:
+        fields = json.load(f)[args.layout]
+    font_paths = renderer.default_font_paths(os.path.join(HERE, 'static', 'fonts'))
+
+    df, cold = time_cold_stages(args, fields, font_paths)
+    print(f"Template {os.path.basename(args.template)}, layout '{args.layout}', "
+          f"{args.workers} worker(s), '{args.preset}' output")
+    print("One-off stages: " + ", ".join(f"{stage} {seconds * 1000:.1f} ms"
+                                         for stage, seconds in cold.items()))
+    print()
+
+    presets = time_presets(args, synthetic_rows(df, 1), fields, font_paths)
+    print(f"{'preset':>14} {'encode ms':>10} {'KB':>8}")
+    for preset, (ms, kb) in presets.items():
+        print(f"{preset:>14} {ms:>10.1f} {kb:>8.0f}")
+    print()
+    print(f"{'rows':>6} {'rows/sec':>9} {'pool r/s':>9} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'copy':>7} {'font':>7} {'draw':>7} {'encode':>7} {'zip':>7} {'RSS MB':>8}")
+
+    results = {
+        'cold_stages': cold,
+        'presets': {preset: {'encode_ms': ms, 'kb': kb} for preset, (ms, kb) in presets.items()},
+        'batches': [],
+    }
+    for count in args.rows:
+        # Each batch size gets fresh pool workers and a reset peak, so its
+        # memory figure isn't carried over from the sizes before it
+        renderer.shutdown_pool()
+        reset_peak_rss()
+        rows = synthetic_rows(df, count)
+        stages, totals = time_row_stages(args, rows, fields, font_paths)
+        pool_seconds, written = time_pipeline(args, rows, fields, font_paths)
+        parent_rss, pool_rss = peak_rss_mb(), pool_peak_rss_mb(args.workers)
+
+        batch = {
+            'rows': count,
+            'rows_per_sec': count / sum(totals),
+            'pool_rows_per_sec': count / pool_seconds,
+            'p50_ms': percentile(totals, 50) * 1000,
+            'p99_ms': percentile(totals, 99) * 1000,
+            'stage_ms': {stage: statistics.mean(values) * 1000 for stage, values in stages.items()},
+            'bytes_written': written,
+            # The parent's and every worker's own peak, added up: an upper
+            # bound on what the batch needed at once
+            'peak_rss_mb': parent_rss + pool_rss if None not in (parent_rss, pool_rss) else None,
+            'parent_peak_rss_mb': parent_rss,
+            'pool_peak_rss_mb': pool_rss,
+        }
+        results['batches'].append(batch)
+
+        stage_ms = batch['stage_ms']
+        rss = f"{batch['peak_rss_mb']:.0f}" if batch['peak_rss_mb'] is not None else 'n/a'
+        print(f"{count:>6} {batch['rows_per_sec']:>9.1f} {batch['pool_rows_per_sec']:>9.1f} "
+              f"{batch['p50_ms']:>8.1f} {batch['p99_ms']:>8.1f} "
+              f"{stage_ms['template_copy']:>7.2f} {stage_ms['font_lookup']:>7.2f} "
+              f"{stage_ms['text_draw']:>7.2f} {stage_ms['encode']:>7.2f} "
+              f"{stage_ms['zip_write']:>7.2f} {rss:>8}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the certificate rendering pipeline")
+    parser.add_argument('--template', default=os.path.join(HERE, 'template2.jpg'))
+    parser.add_argument('--data', default=os.path.join(HERE, 'sample_students_details.xlsx'))
+    parser.add_argument('--coordinates', default=os.path.join(HERE, 'coordinates.json'))
+    parser.add_argument('--layout', default='updatedtemp.jpeg',
+                        help="key in the coordinates file to take the field layout from")
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000, 10000],
+                        help="synthetic batch sizes to run")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="processes for the batch renderer")
+    parser.add_argument('--preset', default=renderer.DEFAULT_PRESET, choices=sorted(renderer.OUTPUT_PRESETS),
+                        help="output preset for the batch runs")
+    parser.add_argument('--presets', nargs='+', default=list(renderer.OUTPUT_PRESETS),
+                        choices=sorted(renderer.OUTPUT_PRESETS), help="presets to compare encode cost of")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args(argv)
+    args.output = renderer.output_settings(args.preset)
+    run(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import csv
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+import openpyxl
+import pandas as pd
+from fileutil import atomic_write
+from metrics import metrics
+
+def file_hash(path):
+    """Return the SHA-256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class SheetCache:
+    """Parsed spreadsheets keyed by content hash.
+
+    A workbook is parsed with pd.read_excel once. The resulting frame is
+    pickled to `folder` and kept in an in-memory LRU of max_frames entries, so
+    later requests skip openpyxl entirely. Callers must treat the returned
+    frames as read-only since they are shared.
+    """
+
+    def __init__(self, folder, max_frames=8):
+        self.folder = folder
+        self.max_frames = max_frames
+        self.hits = 0
+        self.misses = 0
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def load(self, path, content_hash=None):
+        """Return the parsed frame for the spreadsheet at path"""
+        if content_hash is None:
+            content_hash = file_hash(path)
+
+        with self._lock:
+            df = self._frames.get(content_hash)
+            if df is not None:
+                self._frames.move_to_end(content_hash)
+                self.hits += 1
+                return df
+            self.misses += 1
+
+        pickle_path = os.path.join(self.folder, f"{content_hash}.pkl")
+        try:
+            df = pd.read_pickle(pickle_path)
+        except (OSError, ValueError, EOFError):
+            with metrics.timer('certgen_stage_seconds', stage='excel_parse'):
+                df = pd.read_excel(path)
+            # Several workers may parse the same upload at once
+            atomic_write(pickle_path, df.to_pickle)
+
+        with self._lock:
+            self._frames[content_hash] = df
+            while len(self._frames) > self.max_frames:
+                self._frames.popitem(last=False)
+        return df
+
+def iter_rows(path):
+    """Yield the rows of an .xlsx, .csv or .parquet file as {column: value} dicts.
+
+    Rows are read lazily, so memory stays flat however long the file is.
+    Empty cells come back as ''.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.xlsx', '.xlsm'):
+        return _iter_xlsx(path)
+    if extension == '.csv':
+        return _iter_csv(path)
+    if extension == '.parquet':
+        return _iter_parquet(path)
+    raise ValueError(f"Unsupported data file type: {extension or path}")
+
+def _iter_xlsx(path):
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [str(name) if name is not None else f"Unnamed: {i}" for i, name in enumerate(header)]
+        for values in rows:
+            if values is None or all(value is None for value in values):
+                continue
+            yield {column: '' if value is None else value for column, value in zip(columns, values)}
+    finally:
+        # Read-only workbooks keep the file open until closed
+        workbook.close()
+
+def _iter_csv(path):
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        for row in csv.DictReader(f):
+            yield {column: '' if value is None else value for column, value in row.items()}
+
+def _iter_parquet(path):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError("Reading Parquet files needs pyarrow (pip install pyarrow)")
+    for batch in pq.ParquetFile(path).iter_batches():
+        for row in batch.to_pylist():
+            yield {column: '' if value is None else value for column, value in row.items()}
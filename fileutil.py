@@ -0,0 +1,18 @@
+import os
+import tempfile
+
+def atomic_write(path, write, mode='wb'):
+    """Create or replace path with what write(f) writes to the open file f.
+
+    The data goes to a temp file of its own in the same folder, renamed over
+    path once complete, so readers never see a half-written file and
+    concurrent writers, in any process, never write to the same temp file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
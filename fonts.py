@@ -0,0 +1,104 @@
+import os
+import threading
+from collections import OrderedDict
+from PIL import ImageFont
+from metrics import metrics
+
+class FontRegistry:
+    """Shared font lookup for the certificate generators.
+
+    A family is a named list of candidate font files. The first candidate
+    that can be loaded is picked once per family, and FreeTypeFont objects
+    are memoized by (path, size) with LRU eviction past max_fonts.
+    """
+
+    def __init__(self, max_fonts=128):
+        self.max_fonts = max_fonts
+        self.hits = 0
+        self.misses = 0
+        self._families = {}
+        self._resolved = {}
+        self._fonts = OrderedDict()
+        self._default_font = None
+        self._lock = threading.Lock()
+
+    def register(self, family, candidates):
+        """Set the candidate font files for family, in order of preference"""
+        candidates = list(candidates)
+        with self._lock:
+            if self._families.get(family) != candidates:
+                self._families[family] = candidates
+                self._resolved.pop(family, None)
+
+    def resolve(self, family):
+        """Return the font file picked for family, or None for PIL's default font"""
+        with self._lock:
+            if family in self._resolved:
+                return self._resolved[family]
+            candidates = self._families.get(family, [family])
+
+        path = None
+        for candidate in candidates:
+            if _is_loadable(candidate):
+                path = candidate
+                break
+
+        if path is None:
+            print(f"Warning: no font found for '{family}'. Using default font.")
+        else:
+            print(f"Font '{family}' resolved to {path}")
+
+        with self._lock:
+            self._resolved[family] = path
+        return path
+
+    def get(self, family, size):
+        """Return the font for family at size, loading it at most once"""
+        path = self.resolve(family)
+        if path is None:
+            return self._default()
+
+        key = (path, size)
+        with self._lock:
+            font = self._fonts.get(key)
+            if font is not None:
+                self._fonts.move_to_end(key)
+                self.hits += 1
+                return font
+            self.misses += 1
+
+        with metrics.timer('certgen_stage_seconds', stage='font_load'):
+            font = ImageFont.truetype(path, size)
+
+        with self._lock:
+            self._fonts[key] = font
+            while len(self._fonts) > self.max_fonts:
+                self._fonts.popitem(last=False)
+        return font
+
+    def fallbacks(self):
+        """Map each family resolved so far to the font file it uses (None = default)"""
+        with self._lock:
+            return dict(self._resolved)
+
+    def _default(self):
+        if self._default_font is None:
+            self._default_font = ImageFont.load_default()
+        return self._default_font
+
+def _is_loadable(candidate):
+    # Paths must exist as given. Bare file names such as "arial.ttf" are left
+    # to PIL, which also searches the system font directories.
+    is_path = bool(os.path.dirname(candidate))
+    if is_path and not os.path.exists(candidate):
+        return False
+    try:
+        ImageFont.truetype(candidate, 10)
+        return True
+    except Exception as e:
+        if is_path:
+            print(f"Error loading font {candidate}: {e}")
+        return False
+
+# Process-wide registry shared by every generator in this process
+registry = FontRegistry()
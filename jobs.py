@@ -0,0 +1,217 @@
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from fileutil import atomic_write
+
+class Job:
+    """Progress of one background job, mirrored to a JSON file in the job store"""
+
+    # Minimum seconds between progress writes to disk
+    SAVE_INTERVAL = 0.5
+    # The owning process rewrites unfinished records this often, and a record
+    # not rewritten for STALE_AFTER seconds is taken to have lost its owner
+    HEARTBEAT_INTERVAL = 10
+    STALE_AFTER = 60
+
+    def __init__(self, store, job_id, params):
+        self.store = store
+        self.id = job_id
+        self.params = params
+        self.state = 'queued'
+        self.total = 0
+        self.done = 0
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.owner = {'host': socket.gethostname(), 'pid': os.getpid()}
+        self._saved_at = 0
+        self._save_lock = threading.Lock()
+
+    def start(self, total):
+        self.state = 'running'
+        self.total = total
+        self.started_at = time.time()
+        self.save()
+
+    def advance(self, rows=1):
+        self.done += rows
+        if time.time() - self._saved_at >= self.SAVE_INTERVAL:
+            self.save()
+
+    def finish(self, result):
+        self.state = 'done'
+        self.result = result
+        self.finished_at = time.time()
+        self.save()
+
+    def fail(self, error):
+        self.state = 'failed'
+        self.error = error
+        self.finished_at = time.time()
+        self.save()
+
+    def to_dict(self):
+        elapsed = ((self.finished_at or time.time()) - self.started_at) if self.started_at else 0
+        rows_per_sec = self.done / elapsed if elapsed > 0 else 0
+        eta = (self.total - self.done) / rows_per_sec if rows_per_sec and self.state == 'running' else None
+        return {
+            'id': self.id,
+            'state': self.state,
+            'params': self.params,
+            'total': self.total,
+            'done': self.done,
+            'rows_per_sec': round(rows_per_sec, 2),
+            'eta_seconds': round(eta, 1) if eta is not None else None,
+            'submitted_at': self.submitted_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'result': self.result,
+            'error': self.error,
+            'owner': self.owner,
+            'heartbeat_at': time.time(),
+        }
+
+    @property
+    def finished(self):
+        return self.state in ('done', 'failed')
+
+    def save(self):
+        # The heartbeat thread saves too; never let an older snapshot land last
+        with self._save_lock:
+            self._saved_at = time.time()
+            self.store.save(self.to_dict())
+
+class JobStore:
+    """One JSON file per job, so any web worker process can report on any job"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, job_id):
+        return os.path.join(self.folder, f"{job_id}.json")
+
+    def save(self, record):
+        # Another process may be saving the same job at once
+        atomic_write(self.path(record['id']), lambda f: json.dump(record, f), mode='w')
+
+    def load(self, job_id):
+        try:
+            with open(self.path(job_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def records(self):
+        """Yield every stored job record"""
+        for name in os.listdir(self.folder):
+            if name.endswith('.json'):
+                record = self.load(name[:-len('.json')])
+                if record is not None:
+                    yield record
+
+class JobManager:
+    """Runs jobs on a local thread pool and records their progress in a JobStore.
+
+    The threads only coordinate; the heavy rendering inside a job runs on the
+    renderer's shared process pool, so several jobs can be in flight without
+    blocking the web workers.
+
+    A job only lives in the process that accepted it. While it is unfinished
+    that process keeps its record's heartbeat fresh; a record whose owner
+    has exited, or whose heartbeat has gone stale, is marked failed the next
+    time any process looks at it.
+    """
+
+    def __init__(self, folder, max_jobs=2):
+        self.store = JobStore(folder)
+        self._executor = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix='job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._heartbeat = None
+        self._pid = None
+
+    def submit(self, func, params):
+        """Queue func(**params, job=job) and return the new job's id"""
+        job = Job(self.store, uuid.uuid4().hex, params)
+        job.save()
+        with self._lock:
+            self._jobs[job.id] = job
+        self._start_heartbeat()
+        self._executor.submit(self._run, job, func)
+        return job.id
+
+    def status(self, job_id):
+        """Return the stored record of a job, or None if it is unknown"""
+        if not all(c in '0123456789abcdef' for c in job_id):
+            return None
+        record = self.store.load(job_id)
+        return self._reap(record) if record is not None else None
+
+    def active(self):
+        """Records of the queued and running jobs, from every process sharing the store"""
+        records = [self._reap(record) for record in self.store.records()]
+        return [record for record in records if record['state'] in ('queued', 'running')]
+
+    def _reap(self, record):
+        """Mark an unfinished record failed if its owner is gone; returns the record"""
+        if record['state'] not in ('queued', 'running') or not _orphaned(record):
+            return record
+        record.update(state='failed', finished_at=time.time(),
+                      error='The worker running this job stopped before it finished')
+        self.store.save(record)
+        return record
+
+    def _start_heartbeat(self):
+        with self._lock:
+            # A forked worker inherits the attribute but not the thread
+            if self._heartbeat is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._heartbeat = threading.Thread(target=self._beat, name='job-heartbeat', daemon=True)
+            self._heartbeat.start()
+
+    def _beat(self):
+        while True:
+            time.sleep(Job.HEARTBEAT_INTERVAL)
+            with self._lock:
+                jobs = list(self._jobs.values())
+            for job in jobs:
+                if not job.finished and time.time() - job._saved_at >= Job.HEARTBEAT_INTERVAL:
+                    job.save()
+
+    def _run(self, job, func):
+        try:
+            job.finish(func(**job.params, job=job))
+        except Exception as e:
+            traceback.print_exc()
+            job.fail(str(e))
+        finally:
+            with self._lock:
+                self._jobs.pop(job.id, None)
+
+def _orphaned(record):
+    heartbeat = record.get('heartbeat_at') or record.get('submitted_at') or 0
+    if time.time() - heartbeat > Job.STALE_AFTER:
+        return True
+    owner = record.get('owner') or {}
+    if owner.get('host') == socket.gethostname() and owner.get('pid'):
+        return not _pid_alive(owner['pid'])
+    return False
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # Exists, but belongs to someone else
+        return True
+    return True
@@ -0,0 +1,143 @@
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Metrics:
+    """Counters and histograms rendered in the Prometheus text format.
+
+    Values live in this process only. Under gunicorn every worker keeps its
+    own, so a scrape reports the worker that happened to answer it.
+    """
+
+    def __init__(self):
+        self._help = {}
+        self._types = {}
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, help_text, buckets=None):
+        self._help[name] = help_text
+        self._types[name] = (kind, buckets or DEFAULT_BUCKETS)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self._types.get(name, ('histogram', DEFAULT_BUCKETS))[1]
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe how long the with-block took"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def add_collector(self, collect):
+        """Call collect() at scrape time; it returns [(name, labels, value)] counters.
+
+        Collected values are added to whatever inc() counted under the same
+        name and labels.
+        """
+        self._collectors.append(collect)
+
+    def drain(self):
+        """Return everything counted and observed so far, and start again from zero"""
+        with self._lock:
+            drained = (self._counters, self._histograms)
+            self._counters = {}
+            self._histograms = {}
+        return drained
+
+    def merge(self, drained):
+        """Add what drain() returned in another process, such as a pool worker"""
+        counters, histograms = drained
+        with self._lock:
+            for key, value in counters.items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, other in histograms.items():
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    self._histograms[key] = other
+                    continue
+                histogram['buckets'] = [a + b for a, b in zip(histogram['buckets'], other['buckets'])]
+                histogram['sum'] += other['sum']
+                histogram['count'] += other['count']
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: dict(value, buckets=list(value['buckets']))
+                          for key, value in self._histograms.items()}
+        for collect in self._collectors:
+            for name, labels, value in collect():
+                key = (name, tuple(sorted(labels.items())))
+                counters[key] = counters.get(key, 0) + value
+
+        lines = []
+        for name in sorted({key[0] for key in counters}):
+            lines += self._header(name, 'counter')
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+
+        for name in sorted({key[0] for key in histograms}):
+            lines += self._header(name, 'histogram')
+            buckets = self._types.get(name, ('histogram', DEFAULT_BUCKETS))[1]
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, count in zip(buckets, histogram['buckets']):
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', _number(bound)),))} {count}")
+                lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(histogram['sum'])}")
+                lines.append(f"{name}_count{_labels(labels)} {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, name, kind):
+        lines = []
+        if name in self._help:
+            lines.append(f"# HELP {name} {self._help[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+        return lines
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# Process-wide metrics shared by the app and the rendering pipeline
+metrics = Metrics()
+metrics.describe('certgen_request_seconds', 'histogram', 'HTTP request latency by endpoint')
+metrics.describe('certgen_stage_seconds', 'histogram', 'Time spent per pipeline stage',
+                 buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+metrics.describe('certgen_rows_rendered_total', 'counter', 'Certificates rendered')
+metrics.describe('certgen_bytes_written_total', 'counter', 'Certificate bytes written to archives and files')
+metrics.describe('certgen_cache_hits_total', 'counter', 'Cache lookups answered from the cache')
+metrics.describe('certgen_cache_misses_total', 'counter', 'Cache lookups that had to load the value')
+metrics.describe('certgen_files_removed_total', 'counter', 'Expired or over-quota entries deleted by retention')
+metrics.describe('certgen_reclaimed_bytes_total', 'counter', 'Disk space freed by retention')
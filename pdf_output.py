@@ -0,0 +1,318 @@
+"""Certificates as PDF pages with the template embedded once and real text.
+
+Every page of a document draws the same template image XObject, so a
+thousand-page PDF holds the template's pixels once. JPEG templates are
+passed through as-is (DCTDecode) rather than re-encoded. Fields are
+drawn as vector text in the TrueType font they were laid out with; the
+font file is embedded once per document. Fonts PIL could not load from a
+TrueType file fall back to the built-in Helvetica.
+
+    document = PdfDocument('template.jpg')
+    page = document.add_page()
+    page.text((400, 350), 'RAHUL SHARMA', font=font, fill='black')
+    document.save('certificates.pdf')
+
+Coordinates and font sizes are in template pixels, like ImageDraw's, so
+PdfPage can stand in for an ImageDraw.Draw when laying out a certificate.
+"""
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from functools import lru_cache
+from io import BytesIO
+from PIL import Image, ImageColor, ImageFont
+import renderer
+
+# Characters PDF's WinAnsiEncoding can show, by code
+WIN_ANSI = [bytes([code]).decode('cp1252', 'replace') for code in range(256)]
+
+class PdfPage:
+    """One page; text() and textbbox() work like ImageDraw.Draw's"""
+
+    def __init__(self, document):
+        self.document = document
+        self.size = document.size
+        self._items = []
+
+    def text(self, xy, text, fill=None, font=None, spacing=4, **kwargs):
+        font = font or ImageFont.load_default()
+        text = str(text)
+        x, y = xy
+        line_height = font.getbbox('A', anchor='lt')[3] + spacing
+        for line in text.split('\n'):
+            if line:
+                self._items.append((x, y, line, font, _rgb(fill)))
+            y += line_height
+
+    def textbbox(self, xy, text, font=None, **kwargs):
+        font = font or ImageFont.load_default()
+        left, top, right, bottom = font.getbbox(str(text))
+        return (xy[0] + left, xy[1] + top, xy[0] + right, xy[1] + bottom)
+
+    def textlength(self, text, font=None, **kwargs):
+        return (font or ImageFont.load_default()).getlength(str(text))
+
+    def content(self, font_names):
+        """The page's content stream; font_names maps each item's font to its resource"""
+        scale = self.document.scale
+        width, height = self.document.page_size
+        ops = [f"q {_num(width)} 0 0 {_num(height)} 0 0 cm /Tpl Do Q"]
+        for x, y, text, font, color in self._items:
+            name = font_names[_font_file(font)]
+            size = getattr(font, 'size', 10)
+            ascent = font.getmetrics()[0] if hasattr(font, 'getmetrics') else size * 0.8
+            # ImageDraw puts the top of the ascender at y; PDF wants the baseline
+            baseline = height - (y + ascent) * scale
+            ops.append(
+                f"BT /{name} {_num(size * scale)} Tf {' '.join(_num(c / 255) for c in color)} rg "
+                f"1 0 0 1 {_num(x * scale)} {_num(baseline)} Tm ({_escape(text)}) Tj ET"
+            )
+        return '\n'.join(ops).encode('latin-1')
+
+class PdfDocument:
+    """A PDF whose pages all share one template image.
+
+    resolution is the template's pixels per inch, which sets the page size
+    (100 matches what Image.save(..., 'PDF', resolution=100.0) produced).
+    Pages only hold their text until save() writes the file.
+    """
+
+    def __init__(self, template_path, resolution=100.0):
+        self.template_path = template_path
+        with Image.open(template_path) as img:
+            self.size = img.size
+        self.scale = 72.0 / resolution
+        self.page_size = (self.size[0] * self.scale, self.size[1] * self.scale)
+        self.pages = []
+
+    def add_page(self):
+        page = PdfPage(self)
+        self.pages.append(page)
+        return page
+
+    def save(self, fp):
+        """Write the document to a path or a binary file object"""
+        if isinstance(fp, (str, os.PathLike)):
+            with open(fp, 'wb') as f:
+                self.save(f)
+            return
+        writer = _Writer(fp)
+
+        catalog_id, pages_id, resources_id, image_id = (writer.reserve() for _ in range(4))
+
+        font_files = []
+        for page in self.pages:
+            for item in page._items:
+                font_file = _font_file(item[3])
+                if font_file not in font_files:
+                    font_files.append(font_file)
+        font_names = {font_file: f"F{i + 1}" for i, font_file in enumerate(font_files)}
+        font_ids = {font_file: _write_font(writer, font_file) for font_file in font_files}
+
+        page_ids = []
+        for page in self.pages:
+            content_id = writer.stream(page.content(font_names))
+            page_ids.append(writer.add(
+                f"<< /Type /Page /Parent {pages_id} 0 R "
+                f"/MediaBox [0 0 {_num(self.page_size[0])} {_num(self.page_size[1])}] "
+                f"/Resources {resources_id} 0 R /Contents {content_id} 0 R >>"
+            ))
+
+        image_dict, image_data = template_xobject(self.template_path)
+        writer.stream(image_data, image_dict, compress=False, object_id=image_id)
+        fonts = ' '.join(f"/{font_names[font_file]} {font_ids[font_file]} 0 R" for font_file in font_files)
+        writer.add(f"<< /ProcSet [/PDF /Text /ImageC /ImageB] /XObject << /Tpl {image_id} 0 R >> "
+                   f"/Font << {fonts} >> >>", resources_id)
+        writer.add(f"<< /Type /Pages /Kids [{' '.join(f'{i} 0 R' for i in page_ids)}] "
+                   f"/Count {len(page_ids)} >>", pages_id)
+        writer.add(f"<< /Type /Catalog /Pages {pages_id} 0 R >>", catalog_id)
+        writer.finish(catalog_id)
+
+    def tobytes(self):
+        buffered = BytesIO()
+        self.save(buffered)
+        return buffered.getvalue()
+
+class _Writer:
+    """Writes numbered objects to a (possibly unseekable) stream and the xref at the end"""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.offsets = {}
+        self.position = 0
+        self.next_id = 1
+        self.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def write(self, data):
+        self.fp.write(data)
+        self.position += len(data)
+
+    def reserve(self):
+        object_id = self.next_id
+        self.next_id += 1
+        return object_id
+
+    def add(self, body, object_id=None):
+        if object_id is None:
+            object_id = self.reserve()
+        self.offsets[object_id] = self.position
+        if isinstance(body, str):
+            body = body.encode('latin-1')
+        self.write(b"%d 0 obj\n" % object_id + body + b"\nendobj\n")
+        return object_id
+
+    def stream(self, data, entries='', compress=True, object_id=None):
+        if compress:
+            data = zlib.compress(data, 6)
+            entries += ' /Filter /FlateDecode'
+        body = f"<< {entries} /Length {len(data)} >>\nstream\n".encode('latin-1') + data + b"\nendstream"
+        return self.add(body, object_id)
+
+    def finish(self, root_id):
+        xref_at = self.position
+        count = self.next_id
+        lines = [b"xref\n0 %d\n" % count, b"0000000000 65535 f \n"]
+        for object_id in range(1, count):
+            lines.append(b"%010d 00000 n \n" % self.offsets[object_id])
+        self.write(b''.join(lines))
+        self.write(f"trailer\n<< /Size {count} /Root {root_id} 0 R >>\nstartxref\n{xref_at}\n%%EOF\n"
+                   .encode('latin-1'))
+
+# Encoded templates and font programs, reused by every document in this process
+_shared = OrderedDict()
+_shared_lock = threading.Lock()
+MAX_SHARED = 8
+
+def _memoized(kind, path, build):
+    stat = os.stat(path)
+    key = (kind, os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    with _shared_lock:
+        if key in _shared:
+            _shared.move_to_end(key)
+            return _shared[key]
+    value = build(path)
+    with _shared_lock:
+        _shared[key] = value
+        while len(_shared) > MAX_SHARED:
+            _shared.popitem(last=False)
+    return value
+
+def template_xobject(path):
+    """Return (dict entries, data) of the image XObject for the template at path"""
+    return _memoized('image', path, _encode_template)
+
+def _encode_template(path):
+    with Image.open(path) as img:
+        width, height = img.size
+        if img.format == 'JPEG' and img.mode in ('L', 'RGB', 'CMYK'):
+            # JPEG data goes in untouched; PDF viewers decode it themselves
+            colorspace = {'L': 'DeviceGray', 'RGB': 'DeviceRGB', 'CMYK': 'DeviceCMYK'}[img.mode]
+            extra = ' /Decode [1 0 1 0 1 0 1 0]' if img.mode == 'CMYK' else ''
+            with open(path, 'rb') as f:
+                data = f.read()
+            return (f"/Type /XObject /Subtype /Image /Width {width} /Height {height} "
+                    f"/ColorSpace /{colorspace} /BitsPerComponent 8 /Filter /DCTDecode{extra}", data)
+
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            flat = Image.new('RGB', img.size, 'white')
+            flat.paste(img, mask=img.getchannel('A'))
+            img = flat
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        data = zlib.compress(img.tobytes(), 6)
+    return (f"/Type /XObject /Subtype /Image /Width {width} /Height {height} "
+            f"/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /FlateDecode", data)
+
+def _font_file(font):
+    """The TrueType file font was loaded from, or None to use Helvetica"""
+    path = getattr(font, 'path', None)
+    if not isinstance(path, (str, os.PathLike)) or getattr(font, 'index', 0):
+        return None
+    return _truetype_file(path)
+
+@lru_cache(maxsize=64)
+def _truetype_file(path):
+    try:
+        with open(path, 'rb') as f:
+            # Only plain TrueType outlines can be embedded as FontFile2
+            if f.read(4) in (b'\x00\x01\x00\x00', b'true'):
+                return os.path.abspath(path)
+    except OSError:
+        pass
+    return None
+
+def _write_font(writer, font_file):
+    if font_file is None:
+        return writer.add("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica "
+                          "/Encoding /WinAnsiEncoding >>")
+
+    program, base_font, widths, descriptor = _memoized('font', font_file, _load_font_program)
+    # No subsetting: the whole font file is embedded, but only once per document
+    program_id = writer.stream(program, f"/Length1 {len(program)}")
+    descriptor_id = writer.add(f"<< /Type /FontDescriptor /FontName /{base_font} {descriptor} "
+                               f"/FontFile2 {program_id} 0 R >>")
+    return writer.add(
+        f"<< /Type /Font /Subtype /TrueType /BaseFont /{base_font} /FirstChar 32 /LastChar 255 "
+        f"/Widths [{' '.join(str(w) for w in widths)}] /Encoding /WinAnsiEncoding "
+        f"/FontDescriptor {descriptor_id} 0 R >>"
+    )
+
+def _load_font_program(path):
+    with open(path, 'rb') as f:
+        program = f.read()
+    # Measured at 1000px, PIL's pixels are PDF's thousandths of an em
+    font = ImageFont.truetype(path, 1000)
+    family, style = font.getname()
+    base_font = ''.join(c for c in f"{family}-{style}" if c.isascii() and c.isalnum() or c == '-') or 'Font'
+
+    widths = []
+    for code in range(32, 256):
+        char = WIN_ANSI[code]
+        widths.append(0 if char == '\ufffd' else round(font.getlength(char)))
+
+    ascent, descent = font.getmetrics()
+    left, top, right, bottom = font.getbbox(''.join(c for c in WIN_ANSI[32:] if c != '\ufffd'))
+    cap_top = font.getbbox('H')[1]
+    descriptor = (f"/Flags 32 /FontBBox [{left} {ascent - bottom} {right} {ascent - top}] "
+                  f"/ItalicAngle 0 /Ascent {ascent} /Descent {-descent} "
+                  f"/CapHeight {ascent - cap_top} /StemV 80")
+    return program, base_font, widths, descriptor
+
+def _rgb(fill):
+    if fill is None:
+        return (0, 0, 0)
+    if isinstance(fill, str):
+        fill = ImageColor.getrgb(fill)
+    if isinstance(fill, int):
+        return (fill, fill, fill)
+    return tuple(fill[:3])
+
+def _escape(text):
+    data = text.encode('cp1252', 'replace').decode('latin-1')
+    return data.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)').replace('\r', '')
+
+def _num(value):
+    return f"{value:.3f}".rstrip('0').rstrip('.') or '0'
+
+def render_pdf(fp, template_path, rows, fields, font_paths, resolution=100.0):
+    """Write every (filename, row_data) row as a page of one PDF; returns the page count"""
+    document = PdfDocument(template_path, resolution)
+    get_font = renderer.font_loader(font_paths)
+    for _, row_data in rows:
+        page = document.add_page()
+        for _, xy, text, font in renderer.layout_fields(row_data, fields, get_font):
+            page.text(xy, text, fill='black', font=font)
+    document.save(fp)
+    return len(document.pages)
+
+def iter_pdfs(template_path, rows, fields, font_paths, resolution=100.0):
+    """Yield (filename, pdf_bytes), one single-page PDF per (filename, row_data) row"""
+    get_font = renderer.font_loader(font_paths)
+    for filename, row_data in rows:
+        document = PdfDocument(template_path, resolution)
+        page = document.add_page()
+        for _, xy, text, font in renderer.layout_fields(row_data, fields, get_font):
+            page.text(xy, text, fill='black', font=font)
+        yield os.path.splitext(filename)[0] + '.pdf', document.tobytes()
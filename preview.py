@@ -0,0 +1,136 @@
+import math
+import threading
+from collections import OrderedDict
+from PIL import ImageDraw
+import renderer
+
+class PreviewState:
+    """The last preview rendered for one browser session"""
+
+    def __init__(self, base, row_data, scale):
+        self.base = base
+        self.row_data = row_data
+        self.scale = scale
+        self.image = base.copy()
+        self.fields = {}
+        self.boxes = {}
+        self.lock = threading.Lock()
+
+class PreviewEngine:
+    """Incremental preview renderer.
+
+    Keeps the last preview of each session. When only some fields moved or
+    changed size, just their old and new areas are repainted from the clean
+    template and sent back as a tile, instead of re-rendering and
+    re-encoding the whole certificate.
+    """
+
+    def __init__(self, max_sessions=32):
+        self.max_sessions = max_sessions
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, session_id, base, row_data, fields, get_font, scale, full=False):
+        """Bring the session's preview up to date with fields.
+
+        base is the scaled template to draw on and must not be modified.
+        Returns (image, box): box is None when the whole image was redrawn,
+        otherwise the (left, top, right, bottom) area that changed, which is
+        empty when nothing did. image is only valid until the next call.
+        """
+        # Fields are drawn as strings; comparing them that way also keeps
+        # NaN cells from looking like a change on every call
+        row_data = {column: str(value) for column, value in dict(row_data).items()}
+        with self._lock:
+            state = self._states.get(session_id)
+            if (full or state is None or state.base is not base
+                    or state.row_data != row_data or state.scale != scale):
+                state = PreviewState(base, row_data, scale)
+                self._states[session_id] = state
+                full = True
+            self._states.move_to_end(session_id)
+            while len(self._states) > self.max_sessions:
+                self._states.popitem(last=False)
+
+        with state.lock:
+            if full:
+                state.image = base.copy()
+                self._draw(state, state.image, (0, 0, 0, 0), fields, get_font)
+                return state.image, None
+
+            changed = {
+                column for column in set(fields) | set(state.fields)
+                if fields.get(column) != state.fields.get(column)
+            }
+            boxes = self._layout(state, fields, get_font)
+            dirty = None
+            for column in changed:
+                for box in (state.boxes.get(column), boxes.get(column)):
+                    dirty = _union(dirty, box)
+            if dirty is None:
+                state.fields = {column: dict(field) for column, field in fields.items()}
+                return state.image, (0, 0, 0, 0)
+
+            dirty = _clip(dirty, base.size)
+            if dirty[0] >= dirty[2] or dirty[1] >= dirty[3]:
+                # The change is entirely outside the certificate
+                state.fields = {column: dict(field) for column, field in fields.items()}
+                state.boxes = boxes
+                return state.image, (0, 0, 0, 0)
+
+            # Every field touching the dirty area is redrawn on a clean tile,
+            # so neighbours that were partly erased come back and no text is
+            # drawn twice. Grow the area until it holds those fields whole:
+            # PIL positions text differently at negative coordinates.
+            redraw = set()
+            while True:
+                touching = _overlapping(boxes, dirty)
+                if touching == redraw:
+                    break
+                redraw = touching
+                for column in redraw:
+                    dirty = _union(dirty, boxes[column])
+                dirty = _clip(dirty, base.size)
+
+            tile = base.crop(dirty)
+            self._draw(state, tile, dirty, fields, get_font, only=redraw)
+            state.image.paste(tile, dirty[:2])
+            return state.image, dirty
+
+    def _layout(self, state, fields, get_font):
+        boxes = {}
+        for column, (x, y), text, font in renderer.layout_fields(
+                state.row_data, fields, get_font, state.scale):
+            left, top, right, bottom = font.getbbox(text)
+            # The box always includes the text origin, plus a pixel of margin
+            # for anti-aliasing at the glyph edges
+            box = (math.floor(x + min(left, 0)) - 1, math.floor(y + min(top, 0)) - 1,
+                   math.ceil(x + right) + 1, math.ceil(y + bottom) + 1)
+            # A wrapped field's box covers all of its lines
+            boxes[column] = _union(boxes.get(column), box)
+        return boxes
+
+    def _draw(self, state, target, offset, fields, get_font, only=None):
+        draw = ImageDraw.Draw(target)
+        for column, (x, y), text, font in renderer.layout_fields(
+                state.row_data, fields, get_font, state.scale):
+            if only is None or column in only:
+                renderer.text_cache.draw(draw, (x - offset[0], y - offset[1]), text, font)
+        state.fields = {column: dict(field) for column, field in fields.items()}
+        state.boxes = self._layout(state, fields, get_font)
+
+def _union(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+def _clip(box, size):
+    return (max(0, box[0]), max(0, box[1]), min(size[0], box[2]), min(size[1], box[3]))
+
+def _overlapping(boxes, area):
+    return {
+        column for column, box in boxes.items()
+        if box[0] < area[2] and area[0] < box[2] and box[1] < area[3] and area[1] < box[3]
+    }
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+import datasource
+import renderer
+from fileutil import atomic_write
+
+# Bump whenever a rendering change alters the pixels of otherwise identical
+# certificates, so stale renders are never served
+CACHE_VERSION = 1
+
+class RenderCache:
+    """Rendered certificates on disk, addressed by a hash of their inputs.
+
+    The key covers the template bytes, field layout, fonts, the row's values
+    for the placed fields and the output settings. Re-running a batch after
+    editing a few rows only renders those rows; the rest are read back from
+    `folder`.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.hits = 0
+        self.misses = 0
+        self._hashes = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def batch_key(self, template_path, fields, font_paths, output):
+        """Hash of the parts shared by every row of a batch"""
+        fonts = []
+        for path in font_paths:
+            try:
+                stat = os.stat(path)
+                fonts.append((path, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                fonts.append((path, None, None))
+        return _digest({
+            'version': CACHE_VERSION,
+            'template': self.template_hash(template_path),
+            'fields': fields,
+            'fonts': fonts,
+            'output': output,
+        })
+
+    def row_key(self, batch_key, fields, row_data):
+        # Only the placed columns end up in the image, and they are drawn as strings
+        values = {column: str(row_data.get(column, '')) for column in fields}
+        return _digest({'batch': batch_key, 'values': values})
+
+    def template_hash(self, path):
+        """Content hash of the template, remembered while its mtime and size stay the same"""
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            digest = self._hashes.get(key)
+            if digest is not None:
+                return digest
+        digest = datasource.file_hash(path)
+        with self._lock:
+            self._hashes[key] = digest
+            while len(self._hashes) > 64:
+                self._hashes.popitem(last=False)
+        return digest
+
+    def path(self, key, extension):
+        return os.path.join(self.folder, key[:2], f"{key}.{extension}")
+
+    def store(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # A garbled entry would be served for good
+        atomic_write(path, lambda f: f.write(data))
+
+    def iter_rendered(self, template_path, rows, fields, font_paths, output=None, **kwargs):
+        """renderer.iter_rendered, rendering only the rows not already cached.
+
+        rows is read in full up front to find the misses; those are rendered
+        (in order, on the pool) while cached certificates are read back in
+        between, so output order matches rows. Extra keyword arguments go to
+        renderer.iter_rendered.
+        """
+        output = output or renderer.output_settings()
+        extension = renderer.EXTENSIONS[output['format']]
+        batch_key = self.batch_key(template_path, fields, font_paths, output)
+
+        entries = []
+        misses = []
+        for filename, row_data in rows:
+            path = self.path(self.row_key(batch_key, fields, row_data), extension)
+            cached = os.path.exists(path)
+            entries.append((filename, row_data, path, cached))
+            if not cached:
+                misses.append((filename, row_data))
+        with self._lock:
+            self.hits += len(entries) - len(misses)
+            self.misses += len(misses)
+
+        rendered = renderer.iter_rendered(template_path, misses, fields, font_paths,
+                                          output=output, **kwargs)
+        try:
+            for filename, row_data, path, cached in entries:
+                if cached:
+                    try:
+                        with open(path, 'rb') as f:
+                            data = f.read()
+                        # Touch it so age-based cleanup keeps what is still in use
+                        os.utime(path)
+                    except OSError:
+                        # Removed since the lookup; render just this one here
+                        _, data = next(renderer.iter_rendered(template_path, [(filename, row_data)], fields,
+                                                              font_paths, output=output))
+                        self.store(path, data)
+                else:
+                    _, data = next(rendered)
+                    self.store(path, data)
+                yield filename, data
+        finally:
+            rendered.close()
+
+def _digest(value):
+    data = json.dumps(value, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
@@ -0,0 +1,583 @@
+import math
+import multiprocessing
+import os
+import threading
+import time
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import chain, islice
+from io import BytesIO, RawIOBase
+from PIL import Image, ImageDraw, ImageFont
+from fonts import registry
+from textfit import fitter as text_fitter
+from metrics import metrics
+
+# Worker processes shared by all batches (and background jobs) in this process
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+# Font family used for certificate text; callers supply its candidate files
+CERTIFICATE_FONT = 'certificate'
+
+# Most rows handed to a render worker at once
+MAX_CHUNK_ROWS = 16
+
+# Certificate encoder settings by preset name. On a 1280px template 'fast'
+# encodes about 3.5x quicker than 'png' for files ~15% larger; 'archival'
+# is the smallest lossless output but ~6x slower (see benchmark.py --presets)
+OUTPUT_PRESETS = {
+    'png': {'format': 'PNG'},
+    'fast': {'format': 'PNG', 'compress_level': 1},
+    'archival': {'format': 'PNG', 'optimize': True},
+    'jpeg': {'format': 'JPEG', 'quality': 90, 'subsampling': 0},
+    'webp': {'format': 'WEBP', 'quality': 90},
+    'webp-lossless': {'format': 'WEBP', 'lossless': True},
+}
+DEFAULT_PRESET = 'png'
+
+# Settings each format accepts: name -> (type, lowest, highest)
+ENCODER_OPTIONS = {
+    'PNG': {'compress_level': (int, 0, 9), 'optimize': (bool, None, None)},
+    'JPEG': {'quality': (int, 1, 95), 'subsampling': (int, 0, 2),
+             'optimize': (bool, None, None), 'progressive': (bool, None, None)},
+    'WEBP': {'quality': (int, 0, 100), 'lossless': (bool, None, None), 'method': (int, 0, 6)},
+}
+EXTENSIONS = {'PNG': 'png', 'JPEG': 'jpg', 'WEBP': 'webp'}
+
+# Templates with a batch's constant fields drawn in, kept per process
+MAX_BAKED_TEMPLATES = 2
+_baked = OrderedDict()
+_baked_lock = threading.Lock()
+
+class TemplateCache:
+    """Decoded template images shared across rows and sessions.
+
+    Entries are keyed by path (plus the target width for scaled renditions)
+    and invalidated when the file's mtime or size changes. The least recently
+    used entries are evicted once the decoded pixels exceed max_bytes.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, path, width=None):
+        """Return the decoded template. Callers must not draw on it; use copy().
+
+        With a width, return a rendition scaled down to that width instead
+        (never scaled up).
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        key = (path, width)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        img = _decode(path, width)
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= _image_bytes(old[1])
+            self._entries[key] = (version, img)
+            self._bytes += _image_bytes(img)
+            # Always keep the newest entry, even if it alone exceeds the budget
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= _image_bytes(evicted)
+        return img
+
+    def copy(self, path, width=None):
+        """Return a private copy of the template that is safe to draw on"""
+        return self.get(path, width).copy()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+def _decode(path, width):
+    with metrics.timer('certgen_stage_seconds', stage='template_decode'):
+        return _decode_image(path, width)
+
+def _decode_image(path, width):
+    img = Image.open(path)
+    if width is None or width >= img.width:
+        img.load()
+        return img
+
+    size = (width, max(1, round(img.height * width / img.width)))
+    # JPEG can decode straight at 1/2, 1/4 or 1/8 scale, which is far cheaper
+    # than decoding every pixel and throwing most of them away
+    img.draft(img.mode, size)
+    return img.resize(size, Image.Resampling.LANCZOS)
+
+def _image_bytes(img):
+    return img.width * img.height * len(img.getbands())
+
+# Process-wide template cache. Every pool worker gets its own instance.
+template_cache = TemplateCache()
+
+class TextCache:
+    """Rasterized text masks, so values repeated across rows are drawn by a paste.
+
+    Masks are keyed by font, size, text and sub-pixel start, which is all
+    FreeType rasterizes from; the fill colour is applied when the mask is
+    drawn, so one entry serves every colour. The least recently used masks
+    are evicted once they exceed max_bytes. Drawing matches draw.text()
+    pixel for pixel.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def draw(self, draw, xy, text, font, fill='black'):
+        """Draw text at xy like draw.text(xy, text, fill=fill, font=font)"""
+        if (not isinstance(font, ImageFont.FreeTypeFont) or draw.fontmode != 'L'
+                or draw.mode not in ('RGB', 'RGBA', 'L') or '\n' in text or '\r' in text):
+            # Multiline text and other image modes take draw.text's own paths
+            draw.text(xy, text, fill=fill, font=font)
+            return
+
+        x, y = xy
+        start = (math.modf(x)[0], math.modf(y)[0])
+        mask, (left, top) = self.get(font, text, start)
+        draw.bitmap((int(x) + left, int(y) + top), mask, fill=fill)
+
+    def get(self, font, text, start=(0, 0)):
+        """Return (mask, offset) as font.getmask2() would, as an 'L' image"""
+        key = (font.path, font.size, font.index, text, start)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        core, offset = font.getmask2(text, 'L', start=start)
+        entry = (Image.Image()._new(core), offset)
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = entry
+                self._bytes += _image_bytes(entry[0])
+                while self._bytes > self.max_bytes and len(self._entries) > 1:
+                    _, (evicted, _) = self._entries.popitem(last=False)
+                    self._bytes -= _image_bytes(evicted)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+# Shared by every row rendered in this process
+text_cache = TextCache()
+
+def default_font_paths(font_folder):
+    """Font files to try for certificate text, in order of preference"""
+    return [
+        os.path.join(os.environ.get('WINDIR', 'C:/Windows'), 'Fonts', 'arial.ttf'),
+        os.path.join(font_folder, "Emotional Rescue Personal Use.ttf"),
+        os.path.join(font_folder, "FontsFree-Net-GOTHICB0.ttf"),
+    ]
+
+def font_loader(font_paths):
+    """Register font_paths as the certificate font and return a size -> font getter"""
+    registry.register(CERTIFICATE_FONT, font_paths)
+    return lambda font_size: registry.get(CERTIFICATE_FONT, font_size)
+
+def layout_fields(row_data, fields, get_font, scale=1.0):
+    """Yield (column, (x, y), text, font) for every line of every placed field of row_data.
+
+    Field positions and sizes are in full-size template pixels; scale maps
+    them onto a smaller rendition such as a preview. Besides x, y and
+    fontSize a field may set maxWidth; then autoFit shrinks the font (down
+    to minFontSize) until the text fits, and wrap breaks whatever is still
+    too wide onto further lines, lineSpacing pixels apart.
+    """
+    for column, field_data in fields.items():
+        x = field_data.get('x')
+        y = field_data.get('y')
+        font_size = field_data.get('fontSize', 40)
+
+        if x is None or y is None:
+            continue
+
+        text = str(row_data.get(column, ''))
+        lines = [text]
+        max_width = field_data.get('maxWidth')
+        if max_width:
+            # Fitting and wrapping are decided at full size, so a preview
+            # breaks lines exactly where the certificate will
+            if field_data.get('autoFit'):
+                font_size = text_fitter.fit_size(text, get_font, int(font_size), int(max_width),
+                                                 min_size=int(field_data.get('minFontSize') or 10))
+            if field_data.get('wrap'):
+                lines = text_fitter.wrap(text, get_font(font_size), int(max_width)) or ['']
+        line_spacing = int(field_data.get('lineSpacing') or 0) if 'lineSpacing' in field_data else 5
+        full_font = get_font(font_size) if len(lines) > 1 else None
+
+        if scale != 1.0:
+            x, y = x * scale, y * scale
+            font_size = max(1, round(font_size * scale))
+
+        font = get_font(font_size)
+        for line in lines:
+            yield column, (x, y), line, font
+            if full_font is not None:
+                _, top, _, bottom = full_font.getbbox(line)
+                y += (bottom - top + line_spacing) * scale
+
+def draw_fields(img, row_data, fields, get_font, scale=1.0):
+    """Draw every placed field of row_data onto img"""
+    draw = ImageDraw.Draw(img)
+    for _, xy, text, font in layout_fields(row_data, fields, get_font, scale):
+        text_cache.draw(draw, xy, text, font)
+    return img
+
+def output_settings(spec=None):
+    """Return validated encoder settings, e.g. {'format': 'PNG', 'compress_level': 1}.
+
+    spec is a preset name, or a dict with an optional 'preset' and/or
+    'format' plus encoder options overriding the preset's. Raises
+    ValueError for unknown presets, formats or options, and for values
+    of the wrong type: bool options take only true/false, int options
+    only whole numbers.
+    """
+    if spec is None:
+        spec = DEFAULT_PRESET
+    if isinstance(spec, str):
+        spec = {'preset': spec}
+    if not isinstance(spec, dict):
+        raise ValueError(f"Output settings must be a preset name or an object, not {spec!r}")
+    spec = dict(spec)
+
+    preset = spec.pop('preset', None)
+    if preset is None and 'format' not in spec:
+        preset = DEFAULT_PRESET
+    if preset is not None and (not isinstance(preset, str) or preset not in OUTPUT_PRESETS):
+        raise ValueError(f"Unknown output preset: {preset}")
+    settings = dict(OUTPUT_PRESETS[preset]) if preset else {}
+
+    if 'format' in spec:
+        image_format = str(spec.pop('format')).upper()
+        image_format = 'JPEG' if image_format == 'JPG' else image_format
+        if image_format not in ENCODER_OPTIONS:
+            raise ValueError(f"Unsupported output format: {image_format}")
+        if image_format != settings.get('format'):
+            settings = {'format': image_format}
+
+    allowed = ENCODER_OPTIONS[settings['format']]
+    for name, value in spec.items():
+        if name not in allowed:
+            raise ValueError(f"{settings['format']} has no option '{name}'")
+        kind, lowest, highest = allowed[name]
+        # bool is a subclass of int, so it has to be ruled out for int options
+        if not isinstance(value, kind) or (kind is int and isinstance(value, bool)):
+            raise ValueError(f"{name} must be {'true or false' if kind is bool else 'a whole number'}, not {value!r}")
+        if lowest is not None and not lowest <= value <= highest:
+            raise ValueError(f"{name} must be between {lowest} and {highest}")
+        settings[name] = value
+    return settings
+
+def encode_image(img, settings):
+    """Encode img with output_settings() settings and return the bytes"""
+    options = {name: value for name, value in settings.items() if name != 'format'}
+    if settings['format'] == 'JPEG' and img.mode not in ('RGB', 'L', 'CMYK'):
+        img = img.convert('RGB')
+    buffered = BytesIO()
+    img.save(buffered, format=settings['format'], **options)
+    return buffered.getvalue()
+
+def certificate_filename(index, row_data, extension='png'):
+    """Output filename of the certificate for the index'th row (counting from 0)"""
+    first = next(iter(row_data.values()), '')
+    return f"certificate_{index+1}_{str(first).replace(' ', '_')[:30]}.{extension}"
+
+def certificate_rows(df, extension='png'):
+    """Pair every data row with its output filename"""
+    return [
+        (certificate_filename(idx, row_data, extension), row_data)
+        for idx, row_data in enumerate(df.to_dict('records'))
+    ]
+
+def name_rows(rows, extension='png'):
+    """Lazily pair each {column: value} row with its output filename"""
+    for index, row_data in enumerate(rows):
+        yield certificate_filename(index, row_data, extension), row_data
+
+def constant_columns(df, fields):
+    """Return {column: value} for the fields whose value is the same in every row of df"""
+    if len(df) < 2:
+        return {}
+    return {
+        column: df[column].iloc[0]
+        for column in fields
+        if column in df.columns and df[column].nunique(dropna=False) == 1
+    }
+
+def constant_values(rows, columns):
+    """Like constant_columns, for any iterable of {column: value} rows.
+
+    Reads rows only until every column has been seen to vary. Give it a
+    sample of a long stream; iter_rendered copes with later rows that differ.
+    """
+    first = None
+    candidates = set()
+    count = 0
+    for row_data in rows:
+        count += 1
+        if first is None:
+            first = row_data
+            candidates = {column for column in columns if column in row_data}
+            continue
+        candidates = {column for column in candidates if row_data.get(column) == first[column]}
+        if not candidates:
+            break
+    if count < 2:
+        return {}
+    return {column: first[column] for column in columns if column in candidates}
+
+def _load_state(template_path, fields, font_paths, constants=None, output=None):
+    get_font = font_loader(font_paths)
+    plain = template_cache.get(template_path)
+    template, row_fields = plain, fields
+    if constants:
+        template = _baked_template(plain, fields, font_paths, get_font, constants)
+        row_fields = {column: field for column, field in fields.items() if column not in constants}
+    return {
+        'template': template,
+        'fields': row_fields,
+        'constants': constants or {},
+        'plain_template': plain,
+        'all_fields': fields,
+        'get_font': get_font,
+        'output': output or OUTPUT_PRESETS[DEFAULT_PRESET],
+    }
+
+def _baked_template(template, fields, font_paths, get_font, constants):
+    """Return template with the batch's constant fields already drawn on it"""
+    # The template object itself is checked too, so an edited file (which
+    # template_cache decodes again) never reuses a stale base
+    key = (id(template), repr(sorted(fields.items())), repr(sorted(constants.items())), tuple(font_paths))
+    with _baked_lock:
+        entry = _baked.get(key)
+        if entry is not None and entry[0] is template:
+            _baked.move_to_end(key)
+            return entry[1]
+
+    static_fields = {column: field for column, field in fields.items() if column in constants}
+    base = draw_fields(template.copy(), constants, static_fields, get_font)
+
+    with _baked_lock:
+        _baked[key] = (template, base)
+        while len(_baked) > MAX_BAKED_TEMPLATES:
+            _baked.popitem(last=False)
+    return base
+
+def _render(state, task):
+    filename, row_data = task
+    start = time.perf_counter()
+    template, fields = state['template'], state['fields']
+    if not _matches_constants(row_data, state['constants']):
+        # This row differs from what was baked in; draw it in full
+        template, fields = state['plain_template'], state['all_fields']
+    cert = template.copy()
+    copied = time.perf_counter()
+    draw_fields(cert, row_data, fields, state['get_font'])
+    drawn = time.perf_counter()
+    data = encode_image(cert, state['output'])
+    encoded = time.perf_counter()
+    timings = {'template_copy': copied - start, 'text_draw': drawn - copied, 'encode': encoded - drawn}
+    return filename, data, timings
+
+def _matches_constants(row_data, constants):
+    # Compared as drawn, so e.g. a NaN still matches the NaN baked in
+    return all(str(row_data.get(column, '')) == str(value) for column, value in constants.items())
+
+def _render_row(batch, task):
+    # The template and fonts come from this worker's caches, so they are
+    # decoded and loaded once per worker no matter how many rows it renders
+    start = time.perf_counter()
+    state = _load_state(*batch)
+    filename, data, timings = _render(state, task)
+    timings['worker_setup'] = time.perf_counter() - start - sum(timings.values())
+    return filename, data, timings
+
+def _render_chunk(batch, chunk):
+    # Pool workers can't reach the parent's metrics or caches, so the cache
+    # lookups and the stages timed while rendering the chunk (template
+    # decodes, font loads) are sent back with it, for the parent to merge
+    before = _cache_counts()
+    results = [_render_row(batch, task) for task in chunk]
+    for name, (hits, misses) in _cache_counts().items():
+        metrics.inc('certgen_cache_hits_total', hits - before[name][0], cache=name)
+        metrics.inc('certgen_cache_misses_total', misses - before[name][1], cache=name)
+    return results, metrics.drain()
+
+def _cache_counts():
+    caches = {'template': template_cache, 'font': registry, 'text': text_cache}
+    return {name: (cache.hits, cache.misses) for name, cache in caches.items()}
+
+def _start_worker():
+    # Anything counted while the worker imported its modules is not part of a batch
+    metrics.drain()
+
+def _chunk_results(future):
+    results, drained = future.result()
+    metrics.merge(drained)
+    return results
+
+def get_pool(workers):
+    """Return the process pool shared by every batch rendered in this process"""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            # Not forked from this process: its job, heartbeat and sweeper
+            # threads may hold a lock (metrics, caches, stdout) at that
+            # moment, and the child would block on it forever
+            context = multiprocessing.get_context(
+                'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                        initializer=_start_worker)
+            _pool_workers = workers
+        return _pool
+
+def shutdown_pool():
+    """Stop the shared pool's workers; the next batch starts new ones"""
+    with _pool_lock:
+        pool = _pool
+    if pool is not None:
+        _discard_pool(pool)
+
+def _discard_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def iter_rendered(template_path, rows, fields, font_paths, workers=1, stats=None, constants=None,
+                  output=None):
+    """Yield (filename, image_bytes) for each (filename, row_data) pair in rows.
+
+    rows may be a lazy iterator; it is only read a few chunks ahead of the
+    certificates already yielded. Rows are spread across a pool of `workers`
+    processes. Results are yielded in the same order as `rows`, each one as
+    soon as it is ready. Per-stage render times are recorded in metrics and,
+    if given, summed into the stats dict along with a 'rows' count.
+
+    constants maps columns expected to hold the same value in every row
+    (see constant_columns) to that value. Those fields are drawn onto the
+    template once per process instead of once per row. It may be a guess
+    from the first rows: a row that disagrees is drawn in full on the plain
+    template.
+
+    output holds the encoder settings from output_settings(); the default
+    preset is used when it is None. Filenames are not changed, so callers
+    should give them the matching extension (EXTENSIONS).
+    """
+    batch = (template_path, fields, font_paths, constants, output)
+    for filename, data, timings in _iter_rendered(batch, rows, workers):
+        # Workers can't reach this process's metrics, so they send their
+        # timings back with each certificate
+        for stage, seconds in timings.items():
+            metrics.observe('certgen_stage_seconds', seconds, stage=stage)
+            if stats is not None:
+                stats[stage] = stats.get(stage, 0) + seconds
+        metrics.inc('certgen_rows_rendered_total')
+        if stats is not None:
+            stats['rows'] = stats.get('rows', 0) + 1
+        yield filename, data
+
+def _iter_rendered(batch, rows, workers):
+    rows = iter(rows)
+
+    # A pool only pays off when there is more than one row to share out
+    head = list(islice(rows, 2))
+    if workers <= 1 or len(head) < 2:
+        state = _load_state(*batch)
+        for task in chain(head, rows):
+            yield _render(state, task)
+        return
+
+    # Rows are read only as fast as the pool renders them, so a huge or
+    # streamed sheet never has to be held in memory. Chunks start small so
+    # short batches still spread across workers, then grow to keep IPC low.
+    rows = chain(head, rows)
+    pool = get_pool(workers)
+    pending = deque()
+    chunksize = 1
+    try:
+        while True:
+            chunk = list(islice(rows, chunksize))
+            if not chunk:
+                break
+            pending.append(pool.submit(_render_chunk, batch, chunk))
+            chunksize = min(chunksize * 2, MAX_CHUNK_ROWS)
+            if len(pending) >= workers * 2:
+                yield from _chunk_results(pending.popleft())
+        while pending:
+            yield from _chunk_results(pending.popleft())
+    except BrokenProcessPool:
+        # A worker died; start with a fresh pool next time
+        _discard_pool(pool)
+        raise
+    finally:
+        # Stopping early cancels the chunks not yet rendered
+        for future in pending:
+            future.cancel()
+
+class _ChunkWriter(RawIOBase):
+    """Unseekable sink that collects whatever zipfile writes to it"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def stream_zip(entries):
+    """Yield a zip archive of (filename, data) entries chunk by chunk.
+
+    Each entry is sent as soon as it is available, so a download can start
+    before the last certificate is rendered.
+    """
+    sink = _ChunkWriter()
+    with zipfile.ZipFile(sink, 'w') as zipf:
+        for filename, data in entries:
+            zipf.writestr(filename, data)
+            yield sink.drain()
+    yield sink.drain()
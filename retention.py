@@ -0,0 +1,234 @@
+import os
+import shutil
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from metrics import metrics
+
+class Area:
+    """A folder whose entries expire after max_age seconds or once it outgrows max_bytes.
+
+    Entries are the folder's direct children, files or whole directories.
+    With nested=True every file below the folder is an entry of its own, for
+    caches that fan out into subfolders.
+    """
+
+    def __init__(self, name, folder, max_age=None, max_bytes=None, nested=False):
+        self.name = name
+        self.folder = folder
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.nested = nested
+
+    def entries(self):
+        """Yield (path, size, last_used) for every entry, the newest inside a directory"""
+        if self.nested:
+            for root, _, files in os.walk(self.folder):
+                for name in files:
+                    path = os.path.join(root, name)
+                    stat = _stat(path)
+                    if stat:
+                        yield os.path.abspath(path), stat.st_size, _last_used(stat)
+            return
+        try:
+            children = list(os.scandir(self.folder))
+        except OSError:
+            return
+        for entry in children:
+            path = os.path.abspath(entry.path)
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    yield (path,) + _tree_usage(path)
+                else:
+                    stat = entry.stat(follow_symlinks=False)
+                    yield path, stat.st_size, _last_used(stat)
+            except OSError:
+                continue
+
+class Sweeper:
+    """Deletes expired and over-quota entries of some Areas from a background thread.
+
+    Paths held with hold(), or returned by active_paths(), are never removed,
+    nor is anything inside or containing them. Holding a path also touches
+    it, so sweepers in other worker processes see it as recently used. Over
+    quota, the least recently used entries go first, but nothing used
+    within the last `grace` seconds, since it may still be being written.
+    """
+
+    def __init__(self, areas, interval=600, grace=600, active_paths=None):
+        self.areas = areas
+        self.interval = interval
+        self.grace = grace
+        self.active_paths = active_paths
+        self.runs = 0
+        self.removed = 0
+        self.reclaimed_bytes = 0
+        self.last_run = None
+        self._holds = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+
+    @contextmanager
+    def hold(self, *paths):
+        """Keep paths from being swept while the with-block runs"""
+        paths = [os.path.abspath(path) for path in paths if path]
+        for path in paths:
+            touch(path)
+        with self._lock:
+            for path in paths:
+                self._holds[path] = self._holds.get(path, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                for path in paths:
+                    self._holds[path] -= 1
+                    if not self._holds[path]:
+                        del self._holds[path]
+
+    def start(self):
+        """Start sweeping every `interval` seconds; safe to call on every request"""
+        if self.interval <= 0:
+            return
+        with self._lock:
+            # A forked worker inherits the attribute but not the thread
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='retention', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception:
+                traceback.print_exc()
+            if self._stop.wait(self.interval):
+                return
+
+    def sweep(self, now=None):
+        """Remove what has expired or is over quota, returning {area: (removed, reclaimed_bytes)}"""
+        now = now or time.time()
+        protected = self._protected()
+        report = {}
+        for area in self.areas:
+            removed, reclaimed = self._sweep_area(area, now, protected)
+            report[area.name] = (removed, reclaimed)
+            if removed:
+                metrics.inc('certgen_files_removed_total', removed, area=area.name)
+                metrics.inc('certgen_reclaimed_bytes_total', reclaimed, area=area.name)
+
+        removed = sum(count for count, _ in report.values())
+        reclaimed = sum(size for _, size in report.values())
+        with self._lock:
+            self.runs += 1
+            self.removed += removed
+            self.reclaimed_bytes += reclaimed
+            self.last_run = now
+        if removed:
+            print(f"Retention: removed {removed} entries, reclaimed {reclaimed / 1024 / 1024:.1f} MB")
+        return report
+
+    def stats(self):
+        with self._lock:
+            return {
+                'runs': self.runs,
+                'removed': self.removed,
+                'reclaimed_bytes': self.reclaimed_bytes,
+                'last_run': self.last_run,
+            }
+
+    def _protected(self):
+        with self._lock:
+            paths = set(self._holds)
+        if self.active_paths:
+            paths.update(os.path.abspath(path) for path in self.active_paths() if path)
+        return paths
+
+    def _sweep_area(self, area, now, protected):
+        removed = 0
+        reclaimed = 0
+        total = 0
+        candidates = []
+        for path, size, last_used in area.entries():
+            total += size
+            if _is_protected(path, protected):
+                continue
+            if area.max_age is not None and now - last_used > area.max_age:
+                if _remove(path):
+                    removed += 1
+                    reclaimed += size
+                    total -= size
+                continue
+            candidates.append((last_used, path, size))
+
+        if area.max_bytes is not None and total > area.max_bytes:
+            # Least recently used first
+            for last_used, path, size in sorted(candidates):
+                if total <= area.max_bytes or now - last_used < self.grace:
+                    break
+                if _remove(path):
+                    removed += 1
+                    reclaimed += size
+                    total -= size
+        return removed, reclaimed
+
+def touch(path):
+    """Mark path as used now.
+
+    Only the access time moves; caches key on the modification time, so
+    touching a file must not invalidate what they hold for it.
+    """
+    try:
+        os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+    except OSError:
+        pass
+
+def _last_used(stat):
+    return max(stat.st_atime, stat.st_mtime)
+
+def _stat(path):
+    try:
+        return os.stat(path, follow_symlinks=False)
+    except OSError:
+        return None
+
+def _tree_usage(folder):
+    """Total size and latest use of a directory and everything in it"""
+    size = 0
+    newest = _last_used(os.stat(folder))
+    for root, _, files in os.walk(folder):
+        for name in files:
+            stat = _stat(os.path.join(root, name))
+            if stat:
+                size += stat.st_size
+                newest = max(newest, _last_used(stat))
+    return size, newest
+
+def _is_protected(path, protected):
+    for held in protected:
+        if path == held or held.startswith(path + os.sep) or path.startswith(held + os.sep):
+            return True
+    return False
+
+def _remove(path):
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        return True
+    except FileNotFoundError:
+        # Another worker's sweeper got there first
+        return False
+    except OSError as e:
+        print(f"Retention: could not remove {path}: {e}")
+        return False
@@ -1,8 +1,11 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
 import os
 import sys
+from fonts import registry as font_registry
+from textfit import fitter as text_fitter
+from pdf_output import PdfDocument
 
 # ✅ Helper: handle relative paths for fonts (PyInstaller friendly)
 def resource_path(relative_path):
@@ -14,38 +17,19 @@ def resource_path(relative_path):
 
 # ✅ Load font safely
 def load_font(font_file, size):
-    paths_to_try = [
+    font_registry.register(font_file, [
         resource_path(font_file),
         os.path.join("C:\\Windows\\Fonts", font_file),
         os.path.join("C:\\Windows\\Fonts", font_file.replace('.ttf', '.TTF'))
-    ]
-    
-    for path in paths_to_try:
-        if os.path.exists(path):
-            return ImageFont.truetype(path, size)
-    
-    print(f"Warning: Font file '{font_file}' not found. Using default font.")
-    return ImageFont.load_default()
+    ])
+    return font_registry.get(font_file, size)
 
 # ✅ Auto-scale text to fit within max width
 def get_fitted_font(text, font_file, initial_size, max_width, draw):
-    font = load_font(font_file, initial_size)
-    bbox = draw.textbbox((0, 0), text, font=font)
-    text_width = bbox[2] - bbox[0]
-    
-    if text_width <= max_width:
-        return font
-    
-    size = initial_size
-    while size > 20:
-        size -= 2
-        font = load_font(font_file, size)
-        bbox = draw.textbbox((0, 0), text, font=font)
-        text_width = bbox[2] - bbox[0]
-        if text_width <= max_width:
-            return font
-    
-    return font
+    # Tries initial_size and then every 2pt down to about 20, by binary search
+    smallest = 20 - (initial_size - 20) % 2
+    return text_fitter.fit_font(text, lambda size: load_font(font_file, size),
+                                initial_size, max_width, min_size=smallest, step=2)
 
 # ✅ Generate single test certificate
 def generate_test_certificate(template_path, cert_no, full_name, course_name, output_dir, save_format):
@@ -61,8 +45,12 @@ def generate_test_certificate(template_path, cert_no, full_name, course_name, ou
     font_name = load_font("arialbd.ttf", 55)
     font_course = load_font("arial.ttf", 40)
     
-    cert_image = template.copy()
-    draw = ImageDraw.Draw(cert_image)
+    if save_format.upper() == "PDF":
+        document = PdfDocument(template_path, resolution=100.0)
+        draw = document.add_page()
+    else:
+        cert_image = template.copy()
+        draw = ImageDraw.Draw(cert_image)
     
     # Positions (matching your original code)
     cert_no_position = (105, 424)
@@ -91,7 +79,7 @@ def generate_test_certificate(template_path, cert_no, full_name, course_name, ou
     out_path = os.path.join(output_dir, f"{filename}.{ext}")
     
     if save_format.upper() == "PDF":
-        cert_image.save(out_path, "PDF", resolution=100.0)
+        document.save(out_path)
     else:
         cert_image.save(out_path, "PNG")
     
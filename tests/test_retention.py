@@ -0,0 +1,96 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jobs import Job, JobManager
+from retention import Area, Sweeper
+
+DAY = 24 * 3600
+
+class SweeperTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.now = time.time()
+
+    def make(self, name, size, age):
+        path = os.path.join(self.folder, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        when = self.now - age
+        os.utime(path, (when, when))
+        return path
+
+    def listing(self, folder=''):
+        return sorted(os.listdir(os.path.join(self.folder, folder)))
+
+    def test_expired_entries_are_removed(self):
+        self.make('old.jpg', 100, 2 * DAY)
+        self.make('new.jpg', 100, 60)
+        sweeper = Sweeper([Area('uploads', self.folder, max_age=DAY)], interval=0)
+        self.assertEqual(sweeper.sweep(self.now), {'uploads': (1, 100)})
+        self.assertEqual(self.listing(), ['new.jpg'])
+        self.assertEqual(sweeper.stats()['reclaimed_bytes'], 100)
+
+    def test_directories_expire_as_a_whole(self):
+        self.make('batch/a.png', 100, 2 * DAY)
+        self.make('batch/b.png', 100, 2 * DAY)
+        when = self.now - 2 * DAY
+        os.utime(os.path.join(self.folder, 'batch'), (when, when))
+        sweeper = Sweeper([Area('outputs', self.folder, max_age=DAY)], interval=0)
+        self.assertEqual(sweeper.sweep(self.now), {'outputs': (1, 200)})
+        self.assertEqual(self.listing(), [])
+
+    def test_over_quota_removes_least_recently_used_outside_grace(self):
+        self.make('a.zip', 100, 3000)
+        self.make('b.zip', 100, 2000)
+        self.make('c.zip', 100, 1000)
+        self.make('d.zip', 100, 10)
+        sweeper = Sweeper([Area('outputs', self.folder, max_bytes=150)], interval=0, grace=600)
+        sweeper.sweep(self.now)
+        # c.zip still leaves it over quota, but d.zip is within the grace period
+        self.assertEqual(self.listing(), ['d.zip'])
+
+    def test_held_and_active_paths_are_kept(self):
+        held = self.make('held.jpg', 100, 2 * DAY)
+        active = self.make('active.xlsx', 100, 2 * DAY)
+        self.make('batch/inside.png', 100, 2 * DAY)
+        self.make('old.jpg', 100, 2 * DAY)
+        sweeper = Sweeper([Area('uploads', self.folder, max_age=DAY)], interval=0,
+                          active_paths=lambda: [active, os.path.join(self.folder, 'batch', 'inside.png')])
+        with sweeper.hold(held):
+            sweeper.sweep(self.now)
+        self.assertEqual(self.listing(), ['active.xlsx', 'batch', 'held.jpg'])
+        # Released, and touched only by hold(), so it goes once it is old again
+        sweeper.sweep(self.now + 2 * DAY)
+        self.assertNotIn('held.jpg', self.listing())
+
+    def test_nested_area_expires_single_files(self):
+        self.make('ab/old.png', 100, 2 * DAY)
+        self.make('ab/new.png', 100, 60)
+        sweeper = Sweeper([Area('renders', self.folder, max_age=DAY, nested=True)], interval=0)
+        sweeper.sweep(self.now)
+        self.assertEqual(self.listing('ab'), ['new.png'])
+
+    def test_orphaned_jobs_protect_nothing(self):
+        uploads = os.path.join(self.folder, 'uploads')
+        template = self.make('uploads/template.jpg', 100, 2 * DAY)
+        manager = JobManager(os.path.join(self.folder, 'jobs'))
+        record = Job(manager.store, 'ab12', {'template_path': template}).to_dict()
+        record.update(state='running', heartbeat_at=self.now - 2 * Job.STALE_AFTER)
+        manager.store.save(record)
+
+        def active_paths():
+            for job in manager.active():
+                yield job['params'].get('template_path')
+        sweeper = Sweeper([Area('uploads', uploads, max_age=DAY)], interval=0, active_paths=active_paths)
+        sweeper.sweep(self.now)
+        self.assertEqual(self.listing('uploads'), [])
+        self.assertEqual(manager.status('ab12')['state'], 'failed')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import threading
+from collections import OrderedDict
+
+class TextFitter:
+    """Measures, shrinks and wraps text to a width, remembering the answers.
+
+    Word widths are cached per font, so wrapping adds up cached advances
+    instead of re-measuring the whole line after every word; a line is only
+    measured exactly when its estimate lands close to the limit. Font sizes
+    are found by binary search. Whole results are memoized by text, font
+    and width, since the same course or centre names repeat across a batch.
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._results = OrderedDict()
+        self._advances = OrderedDict()
+        self._lock = threading.Lock()
+
+    def width(self, text, font):
+        """Width of text's bounding box, as draw.textbbox((0, 0), ...) measures it"""
+        left, _, right, _ = font.getbbox(text)
+        return right - left
+
+    def fits(self, text, font, max_width):
+        return self.width(text, font) <= max_width
+
+    def fit_size(self, text, get_font, max_size, max_width, min_size=10, step=1):
+        """Return the largest size (max_size down to min_size by step) at which text fits.
+
+        Falls back to the smallest size when even that is too wide.
+        """
+        key = ('fit', text, _font_key(get_font(max_size)), max_size, min_size, step, max_width)
+        size = self._recall(key)
+        if size is not None:
+            return size
+
+        sizes = list(range(max_size, min_size - 1, -step)) or [max_size]
+        # sizes runs from largest to smallest; find the first that fits
+        low, high = 0, len(sizes) - 1
+        best = len(sizes) - 1
+        while low <= high:
+            middle = (low + high) // 2
+            if self.fits(text, get_font(sizes[middle]), max_width):
+                best = middle
+                high = middle - 1
+            else:
+                low = middle + 1
+        size = sizes[best]
+        self._remember(key, size)
+        return size
+
+    def fit_font(self, text, get_font, max_size, max_width, min_size=10, step=1):
+        """Like fit_size, returning get_font(size)"""
+        return get_font(self.fit_size(text, get_font, max_size, max_width, min_size, step))
+
+    def wrap(self, text, font, max_width):
+        """Break text into lines no wider than max_width, at spaces.
+
+        A single word wider than max_width gets a line to itself.
+        """
+        key = ('wrap', text, _font_key(font), max_width)
+        lines = self._recall(key)
+        if lines is not None:
+            return list(lines)
+
+        space = self._advance(' ', font)
+        # Side bearings and kerning keep the summed advances within a few
+        # pixels of the real width; only lines that close are measured
+        margin = max(2, font.size // 2)
+        lines = []
+        current = []
+        current_width = 0
+        for word in text.split():
+            word_width = self._advance(word, font)
+            estimate = current_width + space + word_width if current else word_width
+            if estimate <= max_width - margin:
+                fits = True
+            elif estimate > max_width + margin:
+                fits = False
+            else:
+                fits = self.fits(' '.join(current + [word]), font, max_width)
+
+            if fits:
+                current.append(word)
+                current_width = estimate
+            elif current:
+                lines.append(' '.join(current))
+                current, current_width = [word], word_width
+            else:
+                # A single word that is too long gets a line to itself
+                lines.append(word)
+        if current:
+            lines.append(' '.join(current))
+
+        self._remember(key, tuple(lines))
+        return lines
+
+    def _advance(self, word, font):
+        key = (word, _font_key(font))
+        with self._lock:
+            advance = self._advances.get(key)
+            if advance is not None:
+                self._advances.move_to_end(key)
+                return advance
+        advance = font.getlength(word)
+        with self._lock:
+            self._advances[key] = advance
+            while len(self._advances) > self.max_entries * 4:
+                self._advances.popitem(last=False)
+        return advance
+
+    def _recall(self, key):
+        with self._lock:
+            value = self._results.get(key)
+            if value is not None:
+                self._results.move_to_end(key)
+            return value
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._results[key] = value
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+
+def _font_key(font):
+    return (getattr(font, 'path', None) or id(font), getattr(font, 'size', None), getattr(font, 'index', 0))
+
+fitter = TextFitter()